@@ -4,8 +4,14 @@ import torch.nn.functional as F
 
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.signal import lfilter
 
 from tqdm import tqdm
+import argparse
+import copy
+import os
+import time
+from torch.func import stack_module_state, functional_call, vmap
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -23,6 +29,175 @@ def createDataset(num=1024):
 
     return X, Y
 
+class TensorBatcher:
+    """
+    Mini-batch iterator over tensors that already live on the device.
+
+    Draws one random permutation per epoch and gathers each batch with a single
+    `index_select`, avoiding the per-sample indexing and `default_collate` of
+    `TensorDataset` + `DataLoader`.
+    """
+    def __init__(self, *tensors, batch_size=128, shuffle=True, generator=None):
+        if len(tensors) == 0:
+            raise ValueError("At least one tensor is required")
+        num = tensors[0].shape[0]
+        if any(t.shape[0] != num for t in tensors):
+            raise ValueError("All tensors must have the same size in the first dimension")
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.num = num
+
+    def __len__(self):
+        return (self.num + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        index_device = self.tensors[0].device
+        if self.shuffle and self.generator is not None:
+            # seeded permutations are drawn on the generator's device (CPU) for reproducibility
+            indices = torch.randperm(self.num, generator=self.generator).to(index_device)
+        elif self.shuffle:
+            indices = torch.randperm(self.num, device=index_device)
+        else:
+            indices = torch.arange(self.num, device=index_device)
+        for start in range(0, self.num, self.batch_size):
+            batch_indices = indices[start:start + self.batch_size]
+            yield tuple(t.index_select(0, batch_indices) for t in self.tensors)
+
+def create_loader(X, Y, batch_size, loader="tensor"):
+    """
+    loader: 'tensor' for TensorBatcher (default), 'dataloader' for TensorDataset + DataLoader
+    """
+    if loader == "tensor":
+        return TensorBatcher(X, Y, batch_size=batch_size, shuffle=True)
+    elif loader == "dataloader":
+        dataset = torch.utils.data.TensorDataset(X, Y)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    else:
+        raise ValueError(f"Loader {loader} not recognized.")
+
+class StreamingDataset:
+    """
+    Lazily generated sin(x) dataset of `num` points, produced `chunk_size` points at a time.
+
+    Chunk k is always generated from a RNG seeded with (seed, k), so the data is
+    reproducible without ever being materialized; only one chunk lives on the
+    device at a time. Iterating yields (X, Y) chunks in a seeded per-epoch order.
+    """
+    def __init__(self, num, chunk_size=1_000_000, seed=0, chunks=None):
+        self.num = num
+        self.chunk_size = chunk_size
+        self.seed = seed
+        num_chunks = (num + chunk_size - 1) // chunk_size
+        self.chunks = list(range(num_chunks)) if chunks is None else list(chunks)
+        self.epoch = 0
+
+    def __len__(self):
+        return sum(self.chunk_length(k) for k in self.chunks)
+
+    def chunk_length(self, k):
+        return min(self.chunk_size, self.num - k * self.chunk_size)
+
+    def chunk(self, k):
+        rng = np.random.default_rng((self.seed, k))
+        X = rng.uniform(0, 2 * np.pi, self.chunk_length(k)).astype(np.float32)
+        Y = np.sin(X)
+        X = torch.from_numpy(X).unsqueeze(1).to(device)
+        Y = torch.from_numpy(Y).unsqueeze(1).to(device)
+        return X, Y
+
+    def split(self, ratio=0.9):
+        """Split by whole chunks into two streams with the same seed."""
+        if len(self.chunks) < 2:
+            raise ValueError("Need at least two chunks to split a streaming dataset")
+        num_first = min(max(1, int(ratio * len(self.chunks))), len(self.chunks) - 1)
+        first = StreamingDataset(self.num, self.chunk_size, self.seed, self.chunks[:num_first])
+        second = StreamingDataset(self.num, self.chunk_size, self.seed, self.chunks[num_first:])
+        return first, second
+
+    def __iter__(self):
+        order = np.random.default_rng((self.seed, self.epoch)).permutation(self.chunks)
+        self.epoch += 1
+        for k in order:
+            yield self.chunk(int(k))
+
+    def loader(self, batch_size):
+        return StreamingLoader(self, batch_size)
+
+    def mse(self, model):
+        """Sample-weighted MSE of model over all chunks, as a device tensor."""
+        total = torch.zeros((), device=device)
+        with torch.no_grad():
+            for k in self.chunks:
+                X, Y = self.chunk(k)
+                total += ((model(X) - Y) ** 2).sum()
+        return total / len(self)
+
+class StreamingLoader:
+    """Mini-batches of a StreamingDataset, shuffled within each chunk with a seeded permutation."""
+    def __init__(self, dataset, batch_size):
+        self.dataset = dataset
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        epoch = self.dataset.epoch
+        for i, (X, Y) in enumerate(self.dataset):
+            seed = np.random.SeedSequence((self.dataset.seed, epoch, i)).generate_state(1)[0]
+            generator = torch.Generator().manual_seed(int(seed))
+            yield from TensorBatcher(X, Y, batch_size=self.batch_size, shuffle=True, generator=generator)
+
+class MetricsRecorder:
+    """
+    Record per-epoch scalars into a preallocated on-device buffer.
+
+    Values stay on the device until `flush` copies the pending chunk to the host,
+    which happens every `flush_every` epochs (and at the end), so the training
+    loop does not synchronize on `.item()` every epoch.
+    """
+    def __init__(self, num_epochs, names=("train_loss", "val_loss"), flush_every=100, device=device):
+        self.names = list(names)
+        self.flush_every = flush_every
+        self.buffer = torch.zeros(num_epochs, len(self.names), device=device)
+        self.host = np.zeros((num_epochs, len(self.names)), dtype=np.float32)
+        self.count = 0
+        self.flushed = 0
+
+    def record(self, *values):
+        """Store one row of scalar tensors; returns True when the row triggered a flush."""
+        self.buffer[self.count].copy_(torch.stack([v.detach().float().reshape(()) for v in values]))
+        self.count += 1
+        if self.count - self.flushed >= self.flush_every:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self.count > self.flushed:
+            self.host[self.flushed:self.count] = self.buffer[self.flushed:self.count].cpu().numpy()
+            self.flushed = self.count
+
+    def latest(self):
+        """Last flushed row as a dict."""
+        return dict(zip(self.names, self.host[max(self.flushed - 1, 0)].tolist()))
+
+    def __getitem__(self, name):
+        self.flush()
+        return self.host[:self.count, self.names.index(name)]
+
+ACTIVATIONS = {
+    "sigmoid": nn.Sigmoid,
+    "tanh": nn.Tanh,
+    "relu": nn.ReLU,
+    "gelu": nn.GELU,
+    "silu": nn.SiLU,
+}
+
+def get_activation(name):
+    if name not in ACTIVATIONS:
+        raise ValueError(f"Activation {name} not recognized.")
+    return ACTIVATIONS[name]()
+
 class MLP(nn.Module):
     def __init__(self, input_dim, hidden_dim, output_dim, 
                 num_layers=2, 
@@ -49,6 +224,18 @@ class MLP(nn.Module):
         x = self.layers[-1](x)
         return x
 
+def export_npz(model, path):
+    """Dump MLP.layers weights and the activation name to a flat .npz for np_mlp.NumpyMLP."""
+    names = [name for name, cls in ACTIVATIONS.items() if type(model.activation) is cls]
+    if not names:
+        raise ValueError(f"Activation {type(model.activation).__name__} cannot be exported.")
+    arrays = {"activation": np.array(names[0]), "num_layers": np.array(len(model.layers))}
+    for i, layer in enumerate(model.layers):
+        arrays[f"weight_{i}"] = layer.weight.detach().cpu().numpy()
+        arrays[f"bias_{i}"] = layer.bias.detach().cpu().numpy()
+    np.savez(path, **arrays)
+    return path
+
 def test_model(model, X_val, Y_val, criterion=nn.MSELoss()):
     model.eval()  # Set the model to evaluation mode
     with torch.no_grad():
@@ -56,11 +243,94 @@ def test_model(model, X_val, Y_val, criterion=nn.MSELoss()):
         val_loss = criterion(val_outputs, Y_val)
     return val_loss.item()
 
+def make_train_step(model, criterion, optimizer):
+    def train_step(X_batch, Y_batch):
+        # Forward pass
+        outputs = model(X_batch)
+        loss = criterion(outputs, Y_batch)
+
+        # Backward and optimize
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        return loss.detach()
+    return train_step
+
+class CompiledTrainStep:
+    """
+    The whole train step (forward, backward and optimizer) compiled with torch.compile.
+
+    Compile errors only surface when the step first runs, so the first call falls back to a
+    TorchScript forward inside an eager step if torch.compile is unusable here (e.g. no
+    compiler toolchain). `backend` names the implementation in use once the first call returned.
+    The optimizer is expected to be built with a float lr.
+    """
+    def __init__(self, model, criterion, optimizer):
+        self.model = model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.step = None
+        self.backend = None
+
+    def _set_lr(self, as_tensor):
+        # a tensor lr lets the scheduler change it without recompiling the step, but eager
+        # foreach Adam rejects it, so only the compiled step gets one
+        for group in self.optimizer.param_groups:
+            lr = float(group["lr"])
+            group["lr"] = torch.tensor(lr, device=device) if as_tensor else lr
+
+    def __call__(self, X_batch, Y_batch):
+        if self.step is not None:
+            return self.step(X_batch, Y_batch)
+        try:
+            self._set_lr(as_tensor=True)
+            step = torch.compile(make_train_step(self.model, self.criterion, self.optimizer))
+            loss = step(X_batch, Y_batch)
+            self.backend = "torch.compile"
+        except Exception as e:
+            print(f"torch.compile unavailable ({type(e).__name__}: {e}), falling back to TorchScript")
+            # compilation fails before the step runs, so no update was applied yet
+            self.optimizer.state.clear()
+            self._set_lr(as_tensor=False)
+            traced = torch.jit.trace(self.model, X_batch)
+            step = make_train_step(traced, self.criterion, self.optimizer)
+            loss = step(X_batch, Y_batch)
+            self.backend = "torchscript"
+        self.step = step
+        return loss
+
+def train_epoch(model, dataloader, criterion, optimizer, train_step=None):
+    model.train()  # Set model to training mode
+    if train_step is None:
+        train_step = make_train_step(model, criterion, optimizer)
+    for X_batch, Y_batch in dataloader:
+        loss = train_step(X_batch, Y_batch)
+    # Return the last batch's training loss
+    return loss
+
+def lbfgs_step(model, X, Y, criterion, optimizer):
+    """One closure-based full-batch L-BFGS step; returns the loss before the step."""
+    model.train()
+    def closure():
+        optimizer.zero_grad()
+        loss = criterion(model(X), Y)
+        loss.backward()
+        return loss
+    return optimizer.step(closure)
+
 def train(X, Y, hyper_param):
-    num_data = X.shape[0]
+    """
+    X, Y: in-memory tensors, or a StreamingDataset as X (Y is ignored) which is
+    split by chunks and fed to the model batch by batch.
+    """
+    streaming = isinstance(X, StreamingDataset)
+    if streaming:
+        train_data, val_data = X.split(0.9)
+    else:
+        num_data = X.shape[0]
 
-    X_train, X_val = torch.split(X, [int(0.9 * num_data), num_data - int(0.9 * num_data)], dim=0)
-    Y_train, Y_val = torch.split(Y, [int(0.9 * num_data), num_data - int(0.9 * num_data)], dim=0)
+        X_train, X_val = torch.split(X, [int(0.9 * num_data), num_data - int(0.9 * num_data)], dim=0)
+        Y_train, Y_val = torch.split(Y, [int(0.9 * num_data), num_data - int(0.9 * num_data)], dim=0)
 
     # unpack hyper parameters
     num_epochs = hyper_param["num_epochs"]
@@ -74,82 +344,208 @@ def train(X, Y, hyper_param):
                 hyper_param['activation']
                 ).to(device)
     
-    # Loss and optimizer
-    criterion = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=hyper_param['lr'])
-
     # create a dataloader
-    dataset = torch.utils.data.TensorDataset(X_train, Y_train)
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    if streaming:
+        dataloader = train_data.loader(batch_size)
+    else:
+        dataloader = create_loader(X_train, Y_train, batch_size, hyper_param.get("loader", "tensor"))
 
     # create an optimizer
     criterion = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    optimizer_name = hyper_param.get("optimizer", "adam")
+    if streaming and optimizer_name == "lbfgs":
+        raise ValueError("L-BFGS needs full-batch in-memory data, not a StreamingDataset")
+    use_compile = hyper_param.get("compile", False)
+    if optimizer_name == "adam":
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    elif optimizer_name == "lbfgs":
+        # full-batch quasi-Newton steps, each epoch runs up to max_iter L-BFGS iterations
+        optimizer = torch.optim.LBFGS(model.parameters(), lr=lr,
+                                      max_iter=hyper_param.get("max_iter", 20),
+                                      history_size=hyper_param.get("history_size", 50),
+                                      tolerance_change=hyper_param.get("tol", 1e-12),
+                                      line_search_fn="strong_wolfe")
+    else:
+        raise ValueError(f"Optimizer {optimizer_name} not recognized.")
+    tol = hyper_param.get("tol", 0.0)
+    target_loss = hyper_param.get("target_loss", None)
+
+    train_step = None
+    if use_compile:
+        if optimizer_name == "lbfgs":
+            raise ValueError("The compiled train step only supports the adam optimizer")
+        train_step = CompiledTrainStep(model, criterion, optimizer)
 
     # create scheduler
      # Learning rate scheduler
-    if "gamma" in hyper_param:
+    if "gamma" in hyper_param and optimizer_name != "lbfgs":
         scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=hyper_param['gamma'])
     else:
         scheduler = None
 
     # train the model
-    train_losses = []
-    val_losses = []
+    recorder = MetricsRecorder(num_epochs, flush_every=hyper_param.get("log_every", 100), device=device)
     # Progress bar for the number of epochs
-    progress_bar = tqdm(range(hyper_param['num_epochs']), desc="Training progress")
+    progress_bar = tqdm(range(hyper_param['num_epochs']), desc="Training progress",
+                        disable=not hyper_param.get("progress", True))
+    prev_loss = None
     
     for epoch in progress_bar:
-        model.train()  # Set model to training mode
-
         # Training loop
+        if optimizer_name == "lbfgs":
+            loss = lbfgs_step(model, X_train, Y_train, criterion, optimizer)
+        else:
+            loss = train_epoch(model, dataloader, criterion, optimizer, train_step)
+
+        # Validation step after each epoch
+        model.eval()
+        if streaming:
+            val_loss = val_data.mse(model)
+        else:
+            with torch.no_grad():
+                val_outputs = model(X_val)
+                val_loss = criterion(val_outputs, Y_val)
+
+        # Record the last batch's training loss and the validation loss on the device
+        flushed = recorder.record(loss, val_loss)
+
+        # Update learning rate scheduler
+        if scheduler:
+            scheduler.step()
+
+        # Update progress bar description whenever the losses reach the host
+        if flushed:
+            latest = recorder.latest()
+            progress_bar.set_postfix({"Train Loss": f"{latest['train_loss']:.3e}", "Val Loss": f"{latest['val_loss']:.3e}"})
+            if target_loss is not None and latest['val_loss'] <= target_loss:
+                break
+
+        # L-BFGS already synchronizes inside step(), so checking convergence here is free
+        if optimizer_name == "lbfgs" and tol > 0:
+            current_loss = loss.item()
+            if prev_loss is not None and abs(prev_loss - current_loss) <= tol * max(abs(prev_loss), 1e-12):
+                break
+            prev_loss = current_loss
+
+    progress_bar.close()
+    return recorder["train_loss"], recorder["val_loss"], model
+
+def train_ensemble(X, Y, hyper_param, seeds, lrs=None):
+    """
+    Train len(seeds) same-shaped MLPs in one pass with stacked parameters and vmap.
+
+    All members see the same mini-batches; member k is initialized with seeds[k] and
+    trained with learning rate lrs[k] (default: hyper_param['lr'] for every member).
+
+    Returns:
+        train_losses, val_losses: tensors of shape [num_epochs, num_members]
+        models: list of trained MLPs, one per member
+    """
+    if hyper_param.get("optimizer", "adam") != "adam" or hyper_param.get("compile", False):
+        raise ValueError("The ensemble is trained with eager Adam only")
+    num_data = X.shape[0]
+    num_members = len(seeds)
+
+    X_train, X_val = torch.split(X, [int(0.9 * num_data), num_data - int(0.9 * num_data)], dim=0)
+    Y_train, Y_val = torch.split(Y, [int(0.9 * num_data), num_data - int(0.9 * num_data)], dim=0)
+
+    def build_model():
+        return MLP(hyper_param['input_size'],
+                   hyper_param['hidden_size'],
+                   hyper_param['output_size'],
+                   hyper_param['num_layers'],
+                   hyper_param['activation']
+                   ).to(device)
+
+    models = []
+    for seed in seeds:
+        torch.manual_seed(seed)
+        models.append(build_model())
+    params, buffers = stack_module_state(models)
+    base_model = copy.deepcopy(models[0]).to("meta")
+
+    def member_forward(member_params, member_buffers, x):
+        return functional_call(base_model, (member_params, member_buffers), (x,))
+
+    ensemble_forward = vmap(member_forward, in_dims=(0, 0, None))
+
+    def member_losses(x, y):
+        outputs = ensemble_forward(params, buffers, x)  # [num_members, B, output_size]
+        return ((outputs - y) ** 2).mean(dim=(1, 2))
+
+    # Adam runs with a unit learning rate and each member's update is rescaled by its own lr,
+    # which is exactly Adam with a per-member learning rate.
+    if lrs is None:
+        lrs = [hyper_param['lr']] * num_members
+    if len(lrs) != num_members:
+        raise ValueError("lrs must have the same length as seeds")
+    lrs = torch.tensor(lrs, dtype=torch.float32, device=device)
+    optimizer = torch.optim.Adam(params.values(), lr=1.0)
+    if "gamma" in hyper_param:
+        scheduler = torch.optim.lr_scheduler.ExponentialLR(optimizer, gamma=hyper_param['gamma'])
+    else:
+        scheduler = None
+
+    dataloader = create_loader(X_train, Y_train, hyper_param['batch_size'], hyper_param.get("loader", "tensor"))
+
+    train_losses = []
+    val_losses = []
+    progress_bar = tqdm(range(hyper_param['num_epochs']), desc=f"Ensemble training ({num_members} members)")
+    for epoch in progress_bar:
         for X_batch, Y_batch in dataloader:
-            # Forward pass
-            outputs = model(X_batch)
-            loss = criterion(outputs, Y_batch)
-            
-            # Backward and optimize
+            loss = member_losses(X_batch, Y_batch)
             optimizer.zero_grad()
-            loss.backward()
+            # members are independent, so the gradient of the sum is the per-member gradient
+            loss.sum().backward()
+            old_params = {k: v.detach().clone() for k, v in params.items()}
             optimizer.step()
-        
-        # Record the last batch's training loss
-        train_losses.append(loss.item())
-        
-        # Validation step after each epoch
+            with torch.no_grad():
+                for k, v in params.items():
+                    scale = lrs.view(-1, *([1] * (v.dim() - 1)))
+                    v.copy_(old_params[k] + scale * (v - old_params[k]))
+        train_losses.append(loss.detach())
+
         with torch.no_grad():
-            val_outputs = model(X_val)
-            val_loss = criterion(val_outputs, Y_val)
-            val_losses.append(val_loss.item())
-        
-        # Update learning rate scheduler
+            val_losses.append(member_losses(X_val, Y_val))
+
         if scheduler:
             scheduler.step()
-        
-        # Update progress bar description every epoch with train and validation loss
+
         if(epoch % 10 == 0):
-            progress_bar.set_postfix({"Train Loss": f"{loss.item():.3e}", "Val Loss": f"{val_loss.item():.3e}"})
-            progress_bar.update(10)
-         
+            progress_bar.set_postfix({"Best Val Loss": f"{val_losses[-1].min().item():.3e}"})
+
     progress_bar.close()
-    return train_losses, val_losses, model
-
-def plot_loss(train_losses, val_losses):
-    def smooth_curve(values, smoothing_factor=0.99):
-        smoothed_values = []
-        last = values[0]
-        for value in values:
-            smoothed_value = last * smoothing_factor + (1 - smoothing_factor) * value
-            smoothed_values.append(smoothed_value)
-            last = smoothed_value
-        return smoothed_values
-    
-    train_losses_smoothed = smooth_curve(train_losses)
-    val_losses_smoothed = smooth_curve(val_losses)
+
+    # unstack the trained parameters back into independent models
+    for k, model in enumerate(models):
+        state_dict = {name: v[k].detach().clone() for name, v in params.items()}
+        state_dict.update({name: v[k].clone() for name, v in buffers.items()})
+        model.load_state_dict(state_dict)
+
+    return torch.stack(train_losses).cpu(), torch.stack(val_losses).cpu(), models
+
+def smooth_curve(values, smoothing_factor=0.99):
+    """Exponential moving average, y[t] = a * y[t-1] + (1 - a) * x[t] with y[-1] = x[0]."""
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return values
+    a = smoothing_factor
+    smoothed_values, _ = lfilter([1 - a], [1, -a], values, zi=[a * values[0]])
+    return smoothed_values
+
+def decimate_curve(values, max_points=2000):
+    """Keep at most max_points evenly strided points; returns (x, values)."""
+    stride = max(1, -(-len(values) // max_points))
+    x = np.arange(len(values))[::stride]
+    return x, np.asarray(values)[::stride]
+
+def plot_loss(train_losses, val_losses, max_points=2000):
+    train_x, train_losses_smoothed = decimate_curve(smooth_curve(train_losses), max_points)
+    val_x, val_losses_smoothed = decimate_curve(smooth_curve(val_losses), max_points)
     
     plt.figure(figsize=(10, 6))
-    plt.plot(train_losses_smoothed, label="Training Loss (Smoothed)", color="blue")
-    plt.plot(val_losses_smoothed, label="Validation Loss (Smoothed)", color="red")
+    plt.plot(train_x, train_losses_smoothed, label="Training Loss (Smoothed)", color="blue")
+    plt.plot(val_x, val_losses_smoothed, label="Validation Loss (Smoothed)", color="red")
     plt.yscale("log")  # Log scale for the y-axis
     plt.xlabel("Epoch")
     plt.ylabel("MSE (Log Scale)")
@@ -158,13 +554,219 @@ def plot_loss(train_losses, val_losses):
     plt.savefig("loss.png")
     plt.show()
 
+def benchmark_loader(nums=(1024, 1_000_000), batch_size=128, hidden_size=64, num_layers=4):
+    """Report training epochs/second of the DataLoader path vs. the TensorBatcher path."""
+    criterion = nn.MSELoss()
+    for num in nums:
+        X, Y = createDataset(num)
+        # keep the total number of samples per measurement roughly constant
+        num_epochs = max(1, 2 ** 16 // num)
+        for loader in ["dataloader", "tensor"]:
+            model = MLP(1, hidden_size, 1, num_layers).to(device)
+            optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+            dataloader = create_loader(X, Y, batch_size, loader)
+            train_epoch(model, dataloader, criterion, optimizer)  # warm up
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            for _ in range(num_epochs):
+                train_epoch(model, dataloader, criterion, optimizer)
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            print(f"num={num:>9d} loader={loader:<10s} {num_epochs / elapsed:10.3f} epochs/s")
 
-if __name__ == "__main__":
-    num = 1024
+def benchmark_ensemble(num_members=64, num=1024, num_epochs=100, hidden_size=64, num_layers=4):
+    """Compare wall time of num_members sequential runs against one vectorized ensemble run."""
     X, Y = createDataset(num)
+    hyper_param = {
+        "input_size": 1,
+        "hidden_size": hidden_size,
+        "output_size": 1,
+        "num_layers": num_layers,
+        "activation": nn.Sigmoid(),
+        "num_epochs": num_epochs,
+        "lr": 1e-2,
+        "batch_size": 128,
+    }
+    # time a few sequential runs and extrapolate to num_members
+    num_sequential = min(4, num_members)
+    start = time.perf_counter()
+    for seed in range(num_sequential):
+        torch.manual_seed(seed)
+        train(X, Y, hyper_param)
+    sequential_time = (time.perf_counter() - start) / num_sequential
+
+    start = time.perf_counter()
+    train_ensemble(X, Y, hyper_param, seeds=list(range(num_members)))
+    ensemble_time = time.perf_counter() - start
+
+    print(f"sequential: {sequential_time:.2f} s/run, ~{sequential_time * num_members:.2f} s for {num_members} runs")
+    print(f"ensemble  : {ensemble_time:.2f} s for {num_members} members "
+          f"({ensemble_time / sequential_time:.1f} sequential runs)")
+
+def benchmark_optimizer(num=1024, adam_epochs=15000, lbfgs_epochs=1000):
+    """
+    Time-to-target comparison: the Adam run's best validation MSE is the target
+    that the full-batch L-BFGS run has to reach.
+    """
+    X, Y = createDataset(num)
+    base_param = {
+        "input_size": 1,
+        "hidden_size": 64,
+        "output_size": 1,
+        "num_layers": 4,
+        "activation": nn.Sigmoid(),
+        "batch_size": 128,
+        "log_every": 1,
+    }
+    adam_param = dict(base_param, optimizer="adam", num_epochs=adam_epochs, lr=1e-2,
+                      gamma=(1e-6 / 1e-2) ** (1 / adam_epochs))
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    _, adam_val_losses, _ = train(X, Y, adam_param)
+    adam_time = time.perf_counter() - start
+    target_loss = float(adam_val_losses.min())
+    # Adam reaches the target at its first epoch below it; scale the run time accordingly
+    adam_epoch = int(np.argmax(adam_val_losses <= target_loss)) + 1
+    adam_time_to_target = adam_time * adam_epoch / len(adam_val_losses)
+
+    lbfgs_param = dict(base_param, optimizer="lbfgs", num_epochs=lbfgs_epochs, lr=1.0,
+                       tol=1e-9, target_loss=target_loss)
+    torch.manual_seed(0)
+    start = time.perf_counter()
+    _, lbfgs_val_losses, _ = train(X, Y, lbfgs_param)
+    lbfgs_time = time.perf_counter() - start
+    reached = lbfgs_val_losses.min() <= target_loss
+
+    print(f"target val MSE: {target_loss:.3e}")
+    print(f"adam : {adam_time_to_target:8.2f} s to target ({adam_epoch} epochs), {adam_time:8.2f} s total")
+    print(f"lbfgs: {lbfgs_time:8.2f} s, {len(lbfgs_val_losses)} steps, best val MSE {lbfgs_val_losses.min():.3e}"
+          f"{'' if reached else ' (target not reached)'}")
 
-    X_train, X_test = torch.split(X, [int(0.8 * num), num - int(0.8 * num)], dim=0)
-    Y_train, Y_test = torch.split(Y, [int(0.8 * num), num - int(0.8 * num)], dim=0)
+def benchmark_numpy(path="mlp.npz", nums=(1024, 1_000_000, 10_000_000), hidden_size=64, num_layers=4):
+    """Parity check of np_mlp.NumpyMLP against MLP.forward, plus startup time and throughput."""
+    import subprocess
+    import sys
+    from np_mlp import NumpyMLP
+
+    for name in ACTIVATIONS:
+        model = MLP(1, hidden_size, 1, num_layers, get_activation(name)).eval()
+        export_npz(model, path)
+        np_model = NumpyMLP.load(path)
+        x = np.random.uniform(-4 * np.pi, 4 * np.pi, (4096, 1)).astype(np.float32)
+        with torch.no_grad():
+            expected = model(torch.from_numpy(x)).numpy()
+        max_err = np.abs(np_model(x, chunk_size=1000) - expected).max()
+        assert max_err < 1e-4, f"{name}: max abs error {max_err:.3e}"
+        print(f"parity {name:<8s} max abs error {max_err:.3e}")
+
+    for stmt in ["import torch", "import np_mlp"]:
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", stmt], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        print(f"startup '{stmt}': {time.perf_counter() - start:.3f} s")
+
+    model = MLP(1, hidden_size, 1, num_layers).eval()
+    export_npz(model, path)
+    np_model = NumpyMLP.load(path)
+    for num in nums:
+        x = np.random.uniform(0, 2 * np.pi, (num, 1)).astype(np.float32)
+        start = time.perf_counter()
+        np_model(x)
+        np_time = time.perf_counter() - start
+        start = time.perf_counter()
+        with torch.no_grad():
+            model(torch.from_numpy(x))
+        torch_time = time.perf_counter() - start
+        print(f"num={num:>9d} numpy {num / np_time:12.0f} points/s, torch {num / torch_time:12.0f} points/s")
+
+def benchmark_compile(num_layers_list=(2, 4, 8), hidden_sizes=(16, 64, 256, 512), batch_size=128, num_steps=500):
+    """Report train steps/second of the eager step vs. the compiled step."""
+    criterion = nn.MSELoss()
+    X, Y = createDataset(batch_size)
+    print(f"{'layers':>6s} {'hidden':>6s} {'eager':>10s} {'compiled':>10s} {'speedup':>8s}  backend")
+    for num_layers in num_layers_list:
+        for hidden_size in hidden_sizes:
+            steps_per_second = {}
+            for mode in ["eager", "compiled"]:
+                torch.manual_seed(0)
+                model = MLP(1, hidden_size, 1, num_layers).to(device)
+                optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+                if mode == "eager":
+                    train_step = make_train_step(model, criterion, optimizer)
+                else:
+                    train_step = CompiledTrainStep(model, criterion, optimizer)
+                for _ in range(10):  # warm up (and compile)
+                    train_step(X, Y)
+                if mode == "compiled":
+                    backend = train_step.backend
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                for _ in range(num_steps):
+                    train_step(X, Y)
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                steps_per_second[mode] = num_steps / (time.perf_counter() - start)
+            print(f"{num_layers:>6d} {hidden_size:>6d} {steps_per_second['eager']:>10.0f} {steps_per_second['compiled']:>10.0f} "
+                  f"{steps_per_second['compiled'] / steps_per_second['eager']:>7.2f}x  {backend}")
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description="MLP fitting of sin(x)", add_help=True)
+    parser.add_argument("--bench", type=str, default=None, choices=["loader", "ensemble", "optimizer", "numpy", "compile"], help="run a benchmark and exit")
+    parser.add_argument("--num", type=int, default=1024, help="number of data points")
+    parser.add_argument("--chunk-size", type=int, default=None, help="generate the data lazily in chunks of this size")
+    parser.add_argument("--compile", action="store_true", help="compile the train step (torch.compile, TorchScript fallback)")
+    parser.add_argument("--export", type=str, default=None, help="export the trained model to this .npz for np_mlp.py")
+    parser.add_argument("--optimizer", type=str, default="adam", choices=["adam", "lbfgs"], help="optimizer")
+    parser.add_argument("--ensemble", type=int, default=0, help="train an ensemble of this many seeds in one pass")
+    return parser
+
+if __name__ == "__main__":
+    parser = get_args_parser()
+    args = parser.parse_args()
+    # test, validation and training data are disjoint sets of whole chunks
+    if args.chunk_size is not None and -(-args.num // args.chunk_size) < 3:
+        parser.error(f"--chunk-size {args.chunk_size} gives fewer than 3 chunks of --num {args.num}, "
+                     f"use at most {max(1, args.num // 3)}")
+    # both need the whole training set as in-memory tensors
+    if args.chunk_size is not None and args.ensemble > 0:
+        parser.error("--ensemble cannot be combined with --chunk-size")
+    if args.chunk_size is not None and args.optimizer == "lbfgs":
+        parser.error("--optimizer lbfgs cannot be combined with --chunk-size")
+    # the vmapped ensemble runs eager Adam steps and yields no single model to export
+    if args.ensemble > 0 and args.optimizer != "adam":
+        parser.error("--ensemble only supports --optimizer adam")
+    if args.ensemble > 0 and args.compile:
+        parser.error("--ensemble cannot be combined with --compile")
+    if args.ensemble > 0 and args.export is not None:
+        parser.error("--ensemble cannot be combined with --export")
+    if args.bench == "loader":
+        benchmark_loader()
+        raise SystemExit(0)
+    elif args.bench == "ensemble":
+        benchmark_ensemble()
+        raise SystemExit(0)
+    elif args.bench == "optimizer":
+        benchmark_optimizer()
+        raise SystemExit(0)
+    elif args.bench == "numpy":
+        benchmark_numpy()
+        raise SystemExit(0)
+    elif args.bench == "compile":
+        benchmark_compile()
+        raise SystemExit(0)
+
+    num = args.num
+    if args.chunk_size is not None:
+        # bounded-memory path: train/test are disjoint sets of lazily generated chunks
+        X_train, X_test = StreamingDataset(num, args.chunk_size).split(0.8)
+        Y_train = Y_test = None
+    else:
+        X, Y = createDataset(num)
+
+        X_train, X_test = torch.split(X, [int(0.8 * num), num - int(0.8 * num)], dim=0)
+        Y_train, Y_test = torch.split(Y, [int(0.8 * num), num - int(0.8 * num)], dim=0)
 
     init_lr = 1e-2
     final_lr = 1e-6
@@ -180,14 +782,37 @@ if __name__ == "__main__":
         "num_epochs": epochs,
         "lr": init_lr,
         "batch_size": 128,
-        "gamma": gamma
+        "gamma": gamma,
+        "loader": "tensor",
+        "optimizer": args.optimizer,
+        "compile": args.compile
     }
+    if args.optimizer == "lbfgs":
+        # full-batch steps with a line search: unit step size, no decay, far fewer epochs
+        hyper_param.update({"num_epochs": 1000, "lr": 1.0, "tol": 1e-9, "log_every": 10})
+        hyper_param.pop("gamma")
 
     print(hyper_param)
+    if args.ensemble > 0:
+        train_losses, val_losses, models = train_ensemble(X_train, Y_train, hyper_param, seeds=list(range(args.ensemble)))
+        test_losses = [test_model(m, X_test, Y_test) for m in models]
+        best = int(np.argmin(test_losses))
+        print(f"Ensemble test loss: best {test_losses[best]:.3e} (seed {best}), mean {np.mean(test_losses):.3e}")
+        plot_loss(train_losses[:, best].numpy(), val_losses[:, best].numpy())
+        raise SystemExit(0)
+
     train_losses, val_losses, model = train(X_train, Y_train, hyper_param)
     plot_loss(train_losses, val_losses)
 
-    test_loss = test_model(model, X_test, Y_test)
+    if args.chunk_size is not None:
+        model.eval()
+        test_loss = X_test.mse(model).item()
+    else:
+        test_loss = test_model(model, X_test, Y_test)
     print(f"Test Loss: {test_loss:.3e}")
 
+    if args.export is not None:
+        export_npz(model, args.export)
+        print(f"Model exported to {args.export}")
+
 
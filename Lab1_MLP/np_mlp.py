@@ -0,0 +1,112 @@
+"""
+NumPy-only inference for MLPs exported with `main.export_npz`.
+
+This module deliberately does not import torch, so a scoring service can load a
+trained model without paying for the torch import.
+
+Example:
+    model = NumpyMLP.load("mlp.npz")
+    y = model(x)  # x: [N] -> y: [N], x: [N, input_dim] -> y: [N, output_dim]
+"""
+import numpy as np
+
+
+def _sigmoid(x):
+    # 0.5 * (1 + tanh(x / 2)) equals 1 / (1 + exp(-x)) without overflow for large |x|
+    np.multiply(x, 0.5, out=x)
+    np.tanh(x, out=x)
+    np.add(x, 1.0, out=x)
+    np.multiply(x, 0.5, out=x)
+    return x
+
+
+def _tanh(x):
+    return np.tanh(x, out=x)
+
+
+def _relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def _erf(x):
+    # Abramowitz & Stegun 7.1.26, max absolute error 1.5e-7
+    sign = np.sign(x)
+    a = np.abs(x)
+    t = 1.0 / (1.0 + 0.3275911 * a)
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+    return sign * (1.0 - poly * np.exp(-a * a))
+
+
+def _gelu(x):
+    x *= 0.5 * (1.0 + _erf(x / np.sqrt(2.0)))
+    return x
+
+
+def _silu(x):
+    x *= _sigmoid(x.copy())
+    return x
+
+
+ACTIVATIONS = {
+    "sigmoid": _sigmoid,
+    "tanh": _tanh,
+    "relu": _relu,
+    "gelu": _gelu,
+    "silu": _silu,
+}
+
+
+class NumpyMLP:
+    def __init__(self, weights, biases, activation="sigmoid", dtype=np.float32):
+        """
+        weights: list of [out_dim, in_dim] arrays, in the layout of nn.Linear.weight
+        biases: list of [out_dim] arrays
+        activation: name of the activation between layers
+        """
+        if len(weights) != len(biases) or len(weights) < 2:
+            raise ValueError("Need the same number (>= 2) of weights and biases")
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Activation {activation} not recognized.")
+        # store W^T contiguously so each layer is a single x @ W^T GEMM
+        self.weights_t = [np.ascontiguousarray(np.asarray(w, dtype=dtype).T) for w in weights]
+        self.biases = [np.asarray(b, dtype=dtype) for b in biases]
+        self.activation_name = activation
+        self.activation = ACTIVATIONS[activation]
+        self.dtype = dtype
+        self.input_dim = self.weights_t[0].shape[0]
+        self.output_dim = self.weights_t[-1].shape[1]
+
+    @classmethod
+    def load(cls, path, dtype=np.float32):
+        with np.load(path) as data:
+            num_layers = int(data["num_layers"])
+            weights = [data[f"weight_{i}"] for i in range(num_layers)]
+            biases = [data[f"bias_{i}"] for i in range(num_layers)]
+            activation = str(data["activation"])
+        return cls(weights, biases, activation, dtype=dtype)
+
+    def forward_chunk(self, x):
+        for w_t, b in zip(self.weights_t[:-1], self.biases[:-1]):
+            x = x @ w_t
+            x += b
+            x = self.activation(x)
+        x = x @ self.weights_t[-1]
+        x += self.biases[-1]
+        return x
+
+    def __call__(self, x, chunk_size=65536):
+        """
+        Batched forward pass over x in chunks of chunk_size rows.
+        x: [N, input_dim], or [N] for a single input; the output is [N, output_dim], or [N]
+        when x is [N] and the model has a single output.
+        """
+        x = np.asarray(x, dtype=self.dtype)
+        squeeze = x.ndim == 1 and self.input_dim == 1
+        if squeeze:
+            x = x[:, None]
+        out = np.empty((x.shape[0], self.output_dim), dtype=self.dtype)
+        for start in range(0, x.shape[0], chunk_size):
+            out[start:start + chunk_size] = self.forward_chunk(x[start:start + chunk_size])
+        if squeeze and self.output_dim == 1:
+            return out[:, 0]
+        return out
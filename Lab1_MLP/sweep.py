@@ -0,0 +1,188 @@
+"""
+Hyperparameter sweep for the sin(x) MLP.
+
+Configurations of the grid are trained in parallel worker processes and every
+finished configuration is cached on disk under a hash of its config, so that
+re-running a sweep only trains the configurations that are not done yet.
+
+Example:
+    python sweep.py --hidden-size 32 64 --num-layers 2 4 --activation sigmoid tanh --lr 1e-2 1e-3
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+import main as mlp
+from main import createDataset, train, test_model, get_activation
+
+
+def config_hash(config):
+    """Stable hash of a JSON-serializable config."""
+    text = json.dumps(config, sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def cache_path(cache_dir, config):
+    return os.path.join(cache_dir, f"{config_hash(config)}.json")
+
+
+def load_cached(cache_dir, config):
+    path = cache_path(cache_dir, config)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cached(cache_dir, config, result):
+    # write to a temporary file first so an interrupted sweep never leaves a partial entry
+    path = cache_path(cache_dir, config)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(result, f)
+    os.replace(tmp_path, path)
+
+
+def init_worker(num_threads, device):
+    # each worker only gets its share of the cores
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    # main.py picks CUDA at import time whenever it exists, the sweep decides instead
+    mlp.device = torch.device(device)
+
+
+def run_config(config):
+    """Train one configuration and return its summary; runs inside a worker process."""
+    # every configuration sees the same dataset and initialization
+    np.random.seed(config["seed"])
+    torch.manual_seed(config["seed"])
+
+    num = config["num"]
+    X, Y = createDataset(num)
+    X_train, X_test = torch.split(X, [int(0.8 * num), num - int(0.8 * num)], dim=0)
+    Y_train, Y_test = torch.split(Y, [int(0.8 * num), num - int(0.8 * num)], dim=0)
+
+    hyper_param = {
+        "input_size": 1,
+        "hidden_size": config["hidden_size"],
+        "output_size": 1,
+        "num_layers": config["num_layers"],
+        "activation": get_activation(config["activation"]),
+        "num_epochs": config["num_epochs"],
+        "lr": config["lr"],
+        "batch_size": config["batch_size"],
+        "progress": False,
+    }
+    if config["final_lr"] is not None:
+        hyper_param["gamma"] = (config["final_lr"] / config["lr"]) ** (1 / config["num_epochs"])
+
+    start = time.perf_counter()
+    train_losses, val_losses, model = train(X_train, Y_train, hyper_param)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "config": config,
+        "train_loss": float(train_losses[-1]),
+        "val_loss": float(val_losses[-1]),
+        "best_val_loss": float(val_losses.min()),
+        "test_loss": test_model(model, X_test, Y_test),
+        "time": elapsed,
+    }
+
+
+def build_grid(args):
+    grid = itertools.product(args.hidden_size, args.num_layers, args.activation, args.lr, args.batch_size)
+    return [
+        {
+            "hidden_size": hidden_size,
+            "num_layers": num_layers,
+            "activation": activation,
+            "lr": lr,
+            "batch_size": batch_size,
+            "final_lr": args.final_lr,
+            "num_epochs": args.num_epochs,
+            "num": args.num,
+            "seed": args.seed,
+        }
+        for hidden_size, num_layers, activation, lr, batch_size in grid
+    ]
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep for the sin(x) MLP", add_help=True)
+    parser.add_argument("--hidden-size", type=int, nargs="+", default=[64], help="hidden sizes to try")
+    parser.add_argument("--num-layers", type=int, nargs="+", default=[4], help="numbers of layers to try")
+    parser.add_argument("--activation", type=str, nargs="+", default=["sigmoid"], help="activations to try")
+    parser.add_argument("--lr", type=float, nargs="+", default=[1e-2], help="initial learning rates to try")
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[128], help="batch sizes to try")
+    parser.add_argument("--final-lr", type=float, default=1e-6, help="final lr of the exponential decay")
+    parser.add_argument("-n", "--num-epochs", type=int, default=15000, help="number of epochs per configuration")
+    parser.add_argument("--num", type=int, default=1024, help="dataset size")
+    parser.add_argument("--seed", type=int, default=42, help="seed for data and initialization")
+    parser.add_argument("-j", "--workers", type=int, default=max(1, (os.cpu_count() or 1) // 2), help="number of worker processes")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per worker (default: cpu_count // workers)")
+    parser.add_argument("--device", type=str, default="cpu", help="device of every worker (default: cpu)")
+    parser.add_argument("--cache-dir", type=str, default="./sweep_cache", help="directory of cached results")
+    return parser
+
+
+def main(args):
+    os.makedirs(args.cache_dir, exist_ok=True)
+    configs = build_grid(args)
+
+    results = []
+    pending = []
+    for config in configs:
+        cached = load_cached(args.cache_dir, config)
+        if cached is None:
+            pending.append(config)
+        else:
+            results.append(cached)
+    print(f"{len(configs)} configurations, {len(results)} cached, {len(pending)} to run")
+
+    if pending:
+        workers = min(args.workers, len(pending))
+        threads = args.threads or max(1, (os.cpu_count() or 1) // workers)
+        print(f"Using {workers} workers with {threads} threads each")
+        # spawn: forked workers would inherit the parent's torch/CUDA state
+        context = multiprocessing.get_context("spawn")
+        failed = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                 initargs=(threads, args.device)) as executor:
+            futures = {executor.submit(run_config, config): config for config in pending}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Sweep"):
+                try:
+                    result = future.result()
+                except Exception:
+                    # a failed configuration is reported and retried by the next run, the others go on
+                    failed.append((futures[future], traceback.format_exc()))
+                    continue
+                save_cached(args.cache_dir, result["config"], result)
+                results.append(result)
+        for config, error in failed:
+            print(f"Configuration failed: {json.dumps(config, sort_keys=True)}\n{error}")
+        if failed:
+            print(f"{len(failed)} of {len(pending)} configurations failed")
+
+    results.sort(key=lambda r: r["val_loss"])
+    print(f"{'hidden':>6s} {'layers':>6s} {'activation':>10s} {'lr':>8s} {'batch':>6s} {'val loss':>10s} {'test loss':>10s} {'time':>8s}")
+    for r in results:
+        c = r["config"]
+        print(f"{c['hidden_size']:>6d} {c['num_layers']:>6d} {c['activation']:>10s} {c['lr']:>8.1e} {c['batch_size']:>6d} "
+              f"{r['val_loss']:>10.3e} {r['test_loss']:>10.3e} {r['time']:>7.1f}s")
+    return results
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    main(args)
@@ -0,0 +1,321 @@
+"""
+Throughput benchmarks for the Lab2 data pipeline and models.
+
+Usage:
+    python benchmark.py augment -j 0 2 4 8
+    python benchmark.py loader -j 2 4 8
+    python benchmark.py --device cpu precision -m resnet18 t2t_vit_t_14
+    python benchmark.py layout -m vgg16 resnet18 resnet50 --compile
+    python benchmark.py --device cpu -b 32 fuse -m resnet18 resnet50 vgg16
+"""
+import torch
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader
+
+import numpy as np
+import os
+import time
+import shutil
+import argparse
+import threading
+import copy
+
+from dataloader.augment import BatchAugmentation, ToUint8Tensor, MEAN, STD
+from utils import autocast_dtype, autocast_context
+
+
+class ArrayDataset(Dataset):
+    """uint8 images [N, H, W, 3] with labels, used when no Tiny ImageNet cache is given."""
+    def __init__(self, images, labels, transform):
+        self.images = images
+        self.labels = labels
+        self.transform = transform
+
+    def __getitem__(self, index):
+        return self.transform(np.array(self.images[index])), self.labels[index]
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def load_images(args):
+    if args.data_path is None:
+        rng = np.random.default_rng(0)
+        images = rng.integers(0, 256, (args.num_images, 64, 64, 3), dtype=np.uint8)
+        labels = rng.integers(0, 200, args.num_images)
+        return images, labels
+    from dataloader.dataset import TinyImageNetDataset, RawData
+    dataset = TinyImageNetDataset(type_='train', raw_data=RawData(args.data_path))
+    return dataset.images[:args.num_images], dataset.labels[:args.num_images]
+
+
+def measure(loader, device, augment=None, max_batches=None):
+    """Images per second of iterating the loader, including the optional batch augmentation."""
+    num_images = 0
+    start = time.perf_counter()
+    for i, (x, y) in enumerate(loader):
+        x = x.to(device, non_blocking=True)
+        if augment is not None:
+            x = augment(x)
+        num_images += x.shape[0]
+        if max_batches is not None and i + 1 >= max_batches:
+            break
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return num_images / (time.perf_counter() - start)
+
+
+def bench_augment(args):
+    device = torch.device(args.device)
+    images, labels = load_images(args)
+    pil_transform = transforms.Compose([
+        transforms.ToPILImage(),
+        transforms.RandomResizedCrop(64),
+        transforms.RandomHorizontalFlip(),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=MEAN, std=STD),
+    ])
+    augment = BatchAugmentation().to(device)
+
+    print(f"{args.num_images} images, batch size {args.batch_size}, augmentation on {device}")
+    print(f"{'workers':>7s} {'PIL chain':>12s} {'batch aug':>12s} {'speedup':>8s}")
+    for workers in args.workers:
+        pil_loader = DataLoader(ArrayDataset(images, labels, pil_transform), batch_size=args.batch_size,
+                                shuffle=True, num_workers=workers, pin_memory=device.type == "cuda")
+        uint8_loader = DataLoader(ArrayDataset(images, labels, ToUint8Tensor()), batch_size=args.batch_size,
+                                  shuffle=True, num_workers=workers, pin_memory=device.type == "cuda")
+        pil_rate = measure(pil_loader, device)
+        batch_rate = measure(uint8_loader, device, augment=augment)
+        print(f"{workers:>7d} {pil_rate:>10.0f}/s {batch_rate:>10.0f}/s {batch_rate / pil_rate:>7.2f}x")
+
+
+class ShmMonitor:
+    """Sample the used bytes of /dev/shm in a background thread and keep the peak above the start value."""
+    def __init__(self, path="/dev/shm", interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _used(self):
+        return shutil.disk_usage(self.path).used
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._used() - self.base)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.base = self._used() if os.path.isdir(self.path) else 0
+        if os.path.isdir(self.path):
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if os.path.isdir(self.path):
+            self._thread.join()
+
+
+def bench_loader(args):
+    """Worker-to-main-process throughput of normalized float32 batches vs. raw uint8 batches."""
+    device = torch.device(args.device)
+    images, labels = load_images(args)
+    float_transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=MEAN, std=STD),
+    ])
+    print(f"{args.num_images} images, batch size {args.batch_size}")
+    print(f"{'workers':>7s} {'format':>7s} {'images/s':>10s} {'MiB/batch':>10s} {'peak shm MiB':>13s}")
+    for workers in args.workers:
+        for name, transform in [("float32", float_transform), ("uint8", ToUint8Tensor())]:
+            loader = DataLoader(ArrayDataset(images, labels, transform), batch_size=args.batch_size,
+                                shuffle=True, num_workers=workers, pin_memory=device.type == "cuda")
+            batch_bytes = next(iter(loader))[0].nbytes
+            with ShmMonitor() as shm:
+                rate = measure(loader, torch.device("cpu"))
+            print(f"{workers:>7d} {name:>7s} {rate:>10.0f} {batch_bytes / 2 ** 20:>10.2f} {shm.peak / 2 ** 20:>13.1f}")
+
+
+def build_model(name, num_classes=200):
+    from models.VGG import VGG
+    from models.ResNet import ResNet
+    from models.ViT import T2T_ViT
+    import config
+    if name.startswith("vgg"):
+        return VGG(getattr(config, f"{name}_config"), num_classes)
+    if name.startswith("resnet"):
+        return ResNet(getattr(config, f"{name}_config"), num_classes)
+    if name == "resnext50":
+        return ResNet(config.resnext50_32x4d_config, num_classes)
+    if name.startswith("t2t_vit"):
+        return T2T_ViT(getattr(config, f"{name}_config"), num_classes)
+    raise ValueError(f"Model {name} not recognized.")
+
+
+def time_train_steps(model, x, y, device, amp_dtype, steps, warmup=3):
+    """Images per second of SGD training steps on one fixed batch, and the loss of the last step."""
+    criterion = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    model.train()
+    for i in range(warmup + steps):
+        if i == warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        with autocast_context(device, amp_dtype):
+            y_pred, _ = model(x)
+            loss = criterion(y_pred, y)
+        loss.backward()
+        optimizer.step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return steps * x.shape[0] / (time.perf_counter() - start), loss.item()
+
+
+@torch.no_grad()
+def eval_logits(model, x, device, amp_dtype):
+    model.eval()
+    with autocast_context(device, amp_dtype):
+        y_pred, _ = model(x)
+    return y_pred.float()
+
+
+def bench_precision(args):
+    """Training throughput and prediction agreement of fp32 vs. autocast precisions per model."""
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.randn(args.batch_size, 3, 64, 64, device=device)
+    y = torch.randint(0, 200, (args.batch_size,), device=device)
+    print(f"batch size {args.batch_size}, {args.steps} train steps on {device}")
+    print(f"{'model':>14s} {'precision':>9s} {'train img/s':>12s} {'speedup':>8s} {'loss':>8s} "
+          f"{'top1 agree':>10s} {'max |dlogit|':>12s}")
+    for name in args.models:
+        base = build_model(name).to(device)
+        ref_logits = eval_logits(base, x, device, None)
+        ref_rate = None
+        for precision in ["fp32"] + args.precisions:
+            amp_dtype = autocast_dtype(device, precision)
+            logits = eval_logits(base, x, device, amp_dtype)
+            agree = (logits.argmax(1) == ref_logits.argmax(1)).float().mean().item()
+            max_diff = (logits - ref_logits).abs().max().item()
+            rate, loss = time_train_steps(copy.deepcopy(base), x, y, device, amp_dtype, args.steps)
+            ref_rate = rate if ref_rate is None else ref_rate
+            print(f"{name:>14s} {precision:>9s} {rate:>12.1f} {rate / ref_rate:>7.2f}x {loss:>8.4f} "
+                  f"{agree:>10.3f} {max_diff:>12.4f}")
+
+
+def bench_layout(args):
+    """Training throughput and output parity of NCHW vs. channels_last (and torch.compile) per model."""
+    device = torch.device(args.device)
+    amp_dtype = autocast_dtype(device, args.precision)
+    torch.manual_seed(0)
+    x = torch.randn(args.batch_size, 3, 64, 64, device=device)
+    y = torch.randint(0, 200, (args.batch_size,), device=device)
+    x_nhwc = x.contiguous(memory_format=torch.channels_last)
+    variants = [("nchw", False, False), ("channels_last", True, False)]
+    if args.compile:
+        variants += [("nchw+compile", False, True), ("cl+compile", True, True)]
+    print(f"batch size {args.batch_size}, {args.steps} train steps on {device}, precision {args.precision}")
+    print(f"{'model':>14s} {'layout':>14s} {'train img/s':>12s} {'speedup':>8s} {'max |dlogit|':>12s}")
+    for name in args.models:
+        base = build_model(name).to(device)
+        ref_logits = eval_logits(base, x, device, amp_dtype)
+        ref_rate = None
+        for layout, channels_last, compiled in variants:
+            model = copy.deepcopy(base)
+            inputs = x
+            if channels_last:
+                model = model.to(memory_format=torch.channels_last)
+                inputs = x_nhwc
+            if compiled:
+                model = torch.compile(model)
+            max_diff = (eval_logits(model, inputs, device, amp_dtype) - ref_logits).abs().max().item()
+            # compilation happens during the first steps, keep it out of the timing
+            rate, _ = time_train_steps(model, inputs, y, device, amp_dtype, args.steps, warmup=10 if compiled else 3)
+            ref_rate = rate if ref_rate is None else ref_rate
+            print(f"{name:>14s} {layout:>14s} {rate:>12.1f} {rate / ref_rate:>7.2f}x {max_diff:>12.4f}")
+
+
+@torch.no_grad()
+def time_inference(model, x, device, steps, warmup=3):
+    """Milliseconds per forward pass of the batch x."""
+    model.eval()
+    for i in range(warmup + steps):
+        if i == warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        model(x)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps * 1000
+
+
+def bench_fuse(args):
+    """Inference latency and output parity of models with BatchNorm folded into the convs."""
+    from models.utils import fuse_for_inference
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    x = torch.randn(args.batch_size, 3, 64, 64, device=device)
+    print(f"batch size {args.batch_size}, {args.steps} forward passes on {device}")
+    print(f"{'model':>14s} {'BN ms':>9s} {'fused ms':>9s} {'speedup':>8s} {'max |dlogit|':>12s} {'top1 agree':>10s}")
+    for name in args.models:
+        model = build_model(name).to(device)
+        # a few training steps so the BN running statistics are not the identity
+        time_train_steps(model, x, torch.randint(0, 200, (args.batch_size,), device=device), device, None, steps=1, warmup=2)
+        fused = fuse_for_inference(model)
+        ref_logits = eval_logits(model, x, device, None)
+        logits = eval_logits(fused, x, device, None)
+        max_diff = (logits - ref_logits).abs().max().item()
+        agree = (logits.argmax(1) == ref_logits.argmax(1)).float().mean().item()
+        ref_ms = time_inference(model, x, device, args.steps)
+        fused_ms = time_inference(fused, x, device, args.steps)
+        print(f"{name:>14s} {ref_ms:>9.2f} {fused_ms:>9.2f} {ref_ms / fused_ms:>7.2f}x {max_diff:>12.2e} {agree:>10.3f}")
+        if max_diff > args.atol * max(1.0, ref_logits.abs().max().item()):
+            raise RuntimeError(f"{name}: fused model differs from the original by {max_diff:.3e}")
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description="Lab2 benchmarks", add_help=True)
+    parser.add_argument('-d', "--data-path", type=str, default=None, help="Tiny ImageNet path (default: random images)")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="device")
+    parser.add_argument('-b', "--batch-size", type=int, default=256, help="batch size")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    augment = subparsers.add_parser("augment", help="per-sample PIL transforms vs. BatchAugmentation")
+    augment.add_argument("--num-images", type=int, default=20000, help="number of images to iterate")
+    augment.add_argument('-j', "--workers", type=int, nargs="+", default=[0, 2, 4, 8], help="worker counts to try")
+    augment.set_defaults(func=bench_augment)
+
+    loader = subparsers.add_parser("loader", help="float32 vs. uint8 batches from DataLoader workers")
+    loader.add_argument("--num-images", type=int, default=20000, help="number of images to iterate")
+    loader.add_argument('-j', "--workers", type=int, nargs="+", default=[2, 4, 8], help="worker counts to try")
+    loader.set_defaults(func=bench_loader)
+
+    precision = subparsers.add_parser("precision", help="fp32 vs. autocast training throughput and agreement")
+    precision.add_argument('-m', "--models", type=str, nargs="+", default=["resnet18", "t2t_vit_t_14"], help="models to compare")
+    precision.add_argument("--precisions", type=str, nargs="+", default=["bf16"], choices=["bf16", "fp16"], help="autocast precisions compared with fp32")
+    precision.add_argument("--steps", type=int, default=20, help="timed training steps per model and precision")
+    precision.set_defaults(func=bench_precision)
+
+    layout = subparsers.add_parser("layout", help="NCHW vs. channels_last memory format, optionally compiled")
+    layout.add_argument('-m', "--models", type=str, nargs="+", default=["vgg16", "resnet18", "resnet50"], help="models to compare")
+    layout.add_argument("--precision", type=str, default="fp32", choices=["auto", "fp32", "bf16", "fp16"], help="autocast precision of all variants")
+    layout.add_argument("--compile", action="store_true", help="also time torch.compile'd variants")
+    layout.add_argument("--steps", type=int, default=20, help="timed training steps per model and layout")
+    layout.set_defaults(func=bench_layout)
+
+    fuse = subparsers.add_parser("fuse", help="Conv+BatchNorm folding: inference latency and parity")
+    fuse.add_argument('-m', "--models", type=str, nargs="+", default=["resnet18", "resnet50", "vgg16"], help="models to compare")
+    fuse.add_argument("--steps", type=int, default=20, help="timed forward passes per model")
+    fuse.add_argument("--atol", type=float, default=1e-4, help="largest allowed logit difference, relative to the largest logit")
+    fuse.set_defaults(func=bench_fuse)
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_args_parser().parse_args()
+    args.func(args)
@@ -0,0 +1,151 @@
+"""
+Resumable training checkpoints.
+
+A checkpoint holds everything needed to continue a run where it stopped: model,
+optimizer, LR scheduler and GradScaler states, the epoch, the best validation
+accuracy, the log history and the RNG states of python, numpy and torch (CPU and
+CUDA). The state is snapshotted to CPU memory in the training loop and written
+to disk by a background thread, so the loop only waits for the device-to-host copy.
+"""
+import os
+import copy
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Copy every tensor in a (nested) state dict to CPU memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def unwrap(model):
+    """
+    The module inside DistributedDataParallel and torch.compile wrappers, so state dicts
+    have no 'module.' or '_orig_mod.' prefix.
+    """
+    while True:
+        if hasattr(model, '_orig_mod'):
+            model = model._orig_mod
+        elif hasattr(model, 'module'):
+            model = model.module
+        else:
+            return model
+
+
+def rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(model, optimizer, scheduler=None, scaler=None, epoch=0, best_acc=0.0, log_history=None, rng=None):
+    """
+    CPU copy of the full training state at the end of `epoch`.
+    rng: RNG states to store, defaults to the states of this process.
+    Everything is copied, the training loop may go on mutating its objects while the
+    snapshot is being written.
+    """
+    return {
+        'epoch': epoch,
+        'best_acc': best_acc,
+        'model': to_cpu(unwrap(model).state_dict()),
+        'optimizer': to_cpu(optimizer.state_dict()),
+        'scheduler': copy.deepcopy(scheduler.state_dict()) if scheduler is not None else None,
+        'scaler': copy.deepcopy(scaler.state_dict()) if scaler is not None else None,
+        'log_history': copy.deepcopy(log_history),
+        'rng': rng_state() if rng is None else rng,
+    }
+
+
+def restore(state, model, optimizer, scheduler=None, scaler=None, restore_rng=True):
+    """Load a checkpoint into the training objects; returns the epoch to continue from."""
+    unwrap(model).load_state_dict(state['model'])
+    optimizer.load_state_dict(state['optimizer'])
+    if scheduler is not None and state['scheduler'] is not None:
+        scheduler.load_state_dict(state['scheduler'])
+    if scaler is not None and state['scaler'] is not None:
+        scaler.load_state_dict(state['scaler'])
+    if restore_rng:
+        set_rng_state(state['rng'])
+    return state['epoch'] + 1
+
+
+def load_checkpoint(path):
+    # the RNG states contain numpy arrays and python tuples, so this is not weights_only
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread.
+
+    save() returns as soon as the state is queued; a write replaces the target file
+    only once it is complete. At most one write is pending per writer, a newer save
+    waits for it. Errors of a write are raised by the next save() or close().
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.pth")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, path = item
+            try:
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                self._error = e
+            self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save(self, state, name):
+        self._check()
+        self._queue.put((state, self.path(name)))
+
+    def wait(self):
+        """Block until all queued checkpoints are on disk."""
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
@@ -0,0 +1,101 @@
+"""
+Batched, tensor-level data augmentation.
+
+Workers only hand over raw uint8 images; random resized crops, flips and
+normalization run once per batch (on the training device) instead of once per
+sample through PIL.
+"""
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+MEAN = [0.4802, 0.4481, 0.3975]
+STD = [0.2302, 0.2265, 0.2262]
+
+
+class ToUint8Tensor:
+    """Per-sample transform that turns a numpy or PIL image into a uint8 [H, W, 3] tensor."""
+
+    def __call__(self, image):
+        return torch.from_numpy(np.array(image, dtype=np.uint8))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class BatchAugmentation(nn.Module):
+    def __init__(self, size=64, scale=(0.08, 1.0), ratio=(3. / 4., 4. / 3.), flip_p=0.5,
+                 mean=MEAN, std=STD):
+        """
+        RandomResizedCrop + RandomHorizontalFlip + Normalize for a whole batch.
+
+        Parameters:
+        - size (int): output height and width
+        - scale (tuple): range of the crop area relative to the image area
+        - ratio (tuple): range of the crop aspect ratio (w / h)
+        - flip_p (float): probability of a horizontal flip
+        - mean, std: normalization statistics per channel
+
+        In training mode every sample gets its own crop and flip, in eval mode the
+        batch is only converted and normalized.
+        Input: uint8 tensor [B, H, W, 3]; output: float tensor [B, 3, size, size].
+        """
+        super(BatchAugmentation, self).__init__()
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.flip_p = flip_p
+        # x / 255 then (x - mean) / std, folded into one multiply-add
+        std = torch.tensor(std).view(1, 3, 1, 1)
+        mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.register_buffer("norm_scale", 1.0 / (255.0 * std), persistent=False)
+        self.register_buffer("norm_shift", -mean / std, persistent=False)
+
+    def sample_theta(self, batch_size, device):
+        """Affine matrices mapping output coordinates to a random crop of the input, in [-1, 1] coordinates."""
+        area = torch.empty(batch_size, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(batch_size, device=device).uniform_(*self.log_ratio)
+        ratio = torch.exp(log_ratio)
+        # crop size relative to the image; clamping replaces torchvision's rejection sampling
+        w = torch.sqrt(area * ratio).clamp(max=1.0)
+        h = torch.sqrt(area / ratio).clamp(max=1.0)
+        # crop centers so that the crop stays inside the image
+        cx = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - w)
+        cy = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - h)
+        flip = torch.where(torch.rand(batch_size, device=device) < self.flip_p, -1.0, 1.0)
+
+        theta = torch.zeros(batch_size, 2, 3, device=device)
+        theta[:, 0, 0] = w * flip
+        theta[:, 0, 2] = cx
+        theta[:, 1, 1] = h
+        theta[:, 1, 2] = cy
+        return theta
+
+    def forward(self, x):
+        # [B, H, W, 3] -> [B, 3, H, W]; the permuted view is already channels_last in memory
+        x = x.permute(0, 3, 1, 2).float()
+        B, _, H, W = x.shape
+        if self.training:
+            theta = self.sample_theta(B, x.device)
+            grid = F.affine_grid(theta, (B, 3, self.size, self.size), align_corners=False)
+            x = F.grid_sample(x, grid, mode="bilinear", padding_mode="border", align_corners=False)
+        elif (H, W) != (self.size, self.size):
+            x = F.interpolate(x, size=(self.size, self.size), mode="bilinear", align_corners=False)
+        return x * self.norm_scale + self.norm_shift
+
+
+def build_device_transforms(batch_aug=False, uint8=False):
+    """
+    Batch transforms that run in the training step after the host-to-device copy.
+
+    Returns (train_transform, eval_transform); both are None when the loaders already
+    yield normalized float tensors. With uint8 loaders the eval transform only converts
+    and normalizes, the train transform also crops and flips when batch_aug is set.
+    """
+    if not (batch_aug or uint8):
+        return None, None
+    eval_transform = BatchAugmentation().eval()
+    train_transform = BatchAugmentation() if batch_aug else eval_transform
+    return train_transform, eval_transform
@@ -3,11 +3,32 @@ import os
 import numpy as np
 import cv2
 import torch
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader, Subset, random_split, default_collate
 import torchvision.transforms as transforms
 from multiprocessing import Pool, cpu_count
 from PIL import Image
-from .utils import load_image_multiprocess, apply_transform_multiprocess
+from tqdm import tqdm
+from .augment import ToUint8Tensor
+from .utils import load_image_multiprocess, apply_transform_multiprocess, save_npy, \
+    init_image_buffer, load_image_into_buffer, IMAGE_SHAPE, LRUImageCache
+
+# bump when the decoding or the layout of the processed cache changes
+CACHE_VERSION = 1
+
+def collate_batch(batch):
+    """
+    collate_fn for TinyImageNetDataset: batches already gathered by `__getitems__` are
+    passed through, lists of single samples are collated as usual.
+    """
+    if isinstance(batch, tuple):
+        return batch
+    return default_collate(batch)
+
+def dataset_cache_info(dataset):
+    """cache_info() of a TinyImageNetDataset behind (nested) Subsets, None without an image cache."""
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+    return dataset.cache_info() if isinstance(dataset, TinyImageNetDataset) else None
 
 class RawData:
     def __init__(self, data_path):
@@ -15,11 +36,13 @@ class RawData:
         self.__labels_t_path = os.path.join(self.data_path, "wnids.txt")
         self.__train_data_path = os.path.join(self.data_path, "train/")
         self.__val_data_path = os.path.join(self.data_path, "val/")
+        self.__manifest_path = os.path.join(self.data_path, "process", "manifest.npz")
 
+        self.__manifest = None
         self.__labels_t = None
+        self.__label_ids = None
         self.__image_names = None
         self.__val_labels_t = None
-        self.__val_labels = None
         self.__val_names = None
 
     def train_data_path(self):
@@ -28,151 +51,367 @@ class RawData:
     def val_data_path(self):
         return self.__val_data_path
 
+    def _source_files(self, labels_t):
+        return [self.__labels_t_path, os.path.join(self.__val_data_path, "val_annotations.txt")] + \
+            [os.path.join(self.__train_data_path, label, f"{label}_boxes.txt") for label in labels_t]
+
+    def _fingerprint(self, labels_t):
+        """(mtime_ns, size) of every metadata file the manifest is parsed from."""
+        stats = [os.stat(path) for path in self._source_files(labels_t)]
+        return np.array([(st.st_mtime_ns, st.st_size) for st in stats], dtype=np.int64)
+
+    def _read_labels_t(self):
+        with open(self.__labels_t_path) as wnid:
+            return [line.strip('\n') for line in wnid]
+
+    def _build_manifest(self, labels_t):
+        """Parse wnids.txt, every *_boxes.txt and val_annotations.txt once into flat arrays."""
+        label_ids = {label: i for i, label in enumerate(labels_t)}
+        train_names = []
+        train_offsets = [0]
+        for label in labels_t:
+            txt_path = os.path.join(self.__train_data_path, label, f"{label}_boxes.txt")
+            with open(txt_path) as txt:
+                train_names.extend(line.strip('\n').split('\t')[0] for line in txt)
+            train_offsets.append(len(train_names))
+        val_names = []
+        val_labels = []
+        with open(os.path.join(self.__val_data_path, "val_annotations.txt")) as txt:
+            for line in txt:
+                fields = line.strip('\n').split('\t')
+                val_names.append(fields[0])
+                val_labels.append(label_ids[fields[1]])
+        return {
+            "labels_t": np.array(labels_t),
+            "train_names": np.array(train_names),
+            "train_offsets": np.array(train_offsets, dtype=np.int64),
+            "val_names": np.array(val_names),
+            "val_labels": np.array(val_labels, dtype=np.int64),
+        }
+
+    def manifest(self):
+        """
+        Metadata of the whole dataset as flat arrays: labels_t [C], train_names [N] with
+        train_offsets [C + 1] (class c owns train_names[offsets[c]:offsets[c + 1]]),
+        val_names [M] and val_labels [M].
+        The manifest is cached in process/manifest.npz together with a fingerprint of the
+        metadata files and rebuilt when any of them changes.
+        """
+        if self.__manifest is None:
+            labels_t = self._read_labels_t()
+            fingerprint = self._fingerprint(labels_t)
+            if os.path.exists(self.__manifest_path):
+                with np.load(self.__manifest_path) as data:
+                    if np.array_equal(data["fingerprint"], fingerprint):
+                        self.__manifest = {k: data[k] for k in data.files if k != "fingerprint"}
+            if self.__manifest is None:
+                self.__manifest = self._build_manifest(labels_t)
+                self._save_manifest(fingerprint)
+        return self.__manifest
+
+    def _save_manifest(self, fingerprint):
+        try:
+            os.makedirs(os.path.dirname(self.__manifest_path), exist_ok=True)
+            tmp_path = f"{self.__manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, fingerprint=fingerprint, **self.__manifest)
+            os.replace(tmp_path, self.__manifest_path)
+        except OSError as e:
+            # read-only dataset directory, the manifest is simply rebuilt on the next run
+            print(f"Could not save the dataset manifest to {self.__manifest_path}: {e}")
+
     def labels_t(self):
         if self.__labels_t is None:
-            labels_t = []
-            with open(self.__labels_t_path) as wnid:
-                for line in wnid:
-                    labels_t.append(line.strip('\n'))
-            self.__labels_t = labels_t
+            self.__labels_t = self.manifest()["labels_t"].tolist()
         return self.__labels_t
 
+    def label_ids(self):
+        """wnid -> label id."""
+        if self.__label_ids is None:
+            self.__label_ids = {label: i for i, label in enumerate(self.labels_t())}
+        return self.__label_ids
+
     def image_names(self):
         if self.__image_names is None:
-            image_names = []
-            labels_t = self.labels_t()
-            for label in labels_t:
-                txt_path = os.path.join(self.__train_data_path, label, f"{label}_boxes.txt")
-                image_name = []
-                with open(txt_path) as txt:
-                    for line in txt:
-                        image_name.append(line.strip('\n').split('\t')[0])
-                image_names.append(image_name)
-            self.__image_names = image_names
+            names = self.manifest()["train_names"].tolist()
+            offsets = self.manifest()["train_offsets"]
+            self.__image_names = [names[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
         return self.__image_names
 
     def val_names(self):
         if self.__val_names is None:
-            val_names = []
-            with open(os.path.join(self.__val_data_path, "val_annotations.txt")) as txt:
-                for line in txt:
-                    val_names.append(line.strip('\n').split('\t')[0])
-            self.__val_names = val_names
+            self.__val_names = self.manifest()["val_names"].tolist()
         return self.__val_names
 
     def val_labels_t(self):
         if self.__val_labels_t is None:
-            val_labels_t = []
-            with open(os.path.join(self.__val_data_path, "val_annotations.txt")) as txt:
-                for line in txt:
-                    val_labels_t.append(line.strip('\n').split('\t')[1])
-            self.__val_labels_t = val_labels_t
+            labels_t = self.labels_t()
+            self.__val_labels_t = [labels_t[i] for i in self.val_labels()]
         return self.__val_labels_t
 
     def val_labels(self):
-        if self.__val_labels is None:
-            val_labels = []
-            val_labels_t = self.val_labels_t()
-            labels_t = self.labels_t()
-            for v in val_labels_t:
-                val_labels.append(labels_t.index(v))
-            self.__val_labels = np.array(val_labels)
-        return self.__val_labels
+        return self.manifest()["val_labels"]
+
+    def train_items(self):
+        """(image path, label id) of every training image, grouped by class."""
+        labels_t = self.labels_t()
+        items = []
+        for label_idx, image_list in enumerate(self.image_names()):
+            label_dir = os.path.join(self.__train_data_path, labels_t[label_idx], "images")
+            for image_name in image_list:
+                items.append((os.path.join(label_dir, image_name), label_idx))
+        return items
+
+    def val_items(self):
+        """(image path, label id) of every validation image."""
+        return [(os.path.join(self.__val_data_path, "images", image_name), label)
+                for image_name, label in zip(self.val_names(), self.val_labels())]
 
 
 class TinyImageNetDataset(Dataset):
-    def __init__(self, type_, raw_data, transform=None, force_reload=False, save_processed=True):
+    def __init__(self, type_, raw_data, transform=None, force_reload=False, save_processed=True,
+                 lazy=False, cache_bytes=512 * 2 ** 20):
         """
         type_: 'train' or 'val'
         raw_data: RawData instance
         transform: torchvision transforms to apply
         force_reload: If True, ignore cached data and reprocess
+        lazy: If True, keep only the (path, label) manifest and decode images on access
+        cache_bytes: byte budget of the per-process LRU cache of decoded images in lazy mode
         """
         self.type = type_
         self.raw_data = raw_data
         self.force_reload = force_reload
         self.save_processed = save_processed
+        self.lazy = lazy
         # Create a directory to save processed data
         self.processed_path = os.path.join(self.raw_data.data_path, "process")
         os.makedirs(self.processed_path, exist_ok=True)
 
         # Load or preprocess data
-        if self.type == "train":
+        if self.lazy:
+            tasks = self._train_tasks() if self.type == "train" else self._val_tasks()
+            self.paths = [image_path for image_path, _ in tasks]
+            self.labels = np.array([label for _, label in tasks], dtype=np.int64)
+            self.images = None
+            # each DataLoader worker gets its own copy of the dataset and therefore its own cache
+            self.cache = LRUImageCache(cache_bytes)
+        elif self.type == "train":
             self.images, self.labels = self._load_or_preprocess_train_data()
         else:
             self.images, self.labels = self._load_or_preprocess_val_data()
+        # path of the memory-mapped cache, reopened by workers instead of pickling the array
+        self.images_file = self.images.filename if isinstance(self.images, np.memmap) else None
 
         self.transform = transforms.ToTensor() if transform is None else transform
 
 
     def _load_or_preprocess_train_data(self):
-        train_data_file = os.path.join(self.processed_path, "train_data.npz")
-        if os.path.exists(train_data_file) and not self.force_reload:
-            print(f"Loading preprocessed training data from {train_data_file}...")
-            data = np.load(train_data_file)
-            images = data["images"]
-            labels = data["labels"]
-        else:
-            print("Preprocessing training data...")
-            images, labels = self._preload_train_data()
-            if self.save_processed:
-                print(f"Saving preprocessed training data to {train_data_file}...")
-                np.savez(train_data_file, images=images, labels=labels)
-        return images, labels
+        return self._load_or_preprocess("train", self._train_tasks())
 
     def _load_or_preprocess_val_data(self):
-        val_data_file = os.path.join(self.processed_path, "val_data.npz")
-        if os.path.exists(val_data_file) and not self.force_reload:
-            print(f"Loading preprocessed validation data from {val_data_file}...")
-            data = np.load(val_data_file)
-            images = data["images"]
-            labels = data["labels"]
-        else:
-            print("Preprocessing validation data...")
-            images, labels = self._preload_val_data()
-            if self.save_processed:
-                print(f"Saving preprocessed validation data to {val_data_file}...")
-                np.savez(val_data_file, images=images, labels=labels)
-        return images, labels
-
-    def _preload_train_data(self):
-        labels_t = self.raw_data.labels_t()
-        image_names = self.raw_data.image_names()
-        tasks = []
-        for label_idx, image_list in enumerate(image_names):
-            label_dir = os.path.join(self.raw_data.train_data_path(), labels_t[label_idx], "images")
-            for image_name in image_list:
-                image_path = os.path.join(label_dir, image_name)
-                tasks.append((image_path, label_idx))
+        return self._load_or_preprocess("val", self._val_tasks())
 
-        num_workers = min(cpu_count(), 16)
-        print(f"Using {num_workers} workers for multiprocessing (train)...")
-        with Pool(processes=num_workers) as pool:
-            results = pool.map(load_image_multiprocess, tasks)
+    def _load_or_preprocess(self, split, tasks):
+        """
+        The cache is a pair of raw .npy files per split: uint8 images [N, 64, 64, 3] and int64 labels [N].
+        Images are opened with mmap_mode='r', so DataLoader workers and DDP ranks share one copy
+        through the OS page cache instead of each holding the whole dataset in RAM.
 
-        train_images, train_labels = zip(*results)
-        train_labels = np.array(train_labels)
-        return train_images, train_labels
+        {split}_meta.npz records the preprocessing parameters and the (path, size, mtime) of the
+        source image behind every row. When the source files change, only the new or modified
+        images are decoded; all other rows are copied over from the existing cache.
+        """
+        images_file = os.path.join(self.processed_path, f"{split}_images.npy")
+        labels_file = os.path.join(self.processed_path, f"{split}_labels.npy")
+        meta_file = os.path.join(self.processed_path, f"{split}_meta.npz")
+        legacy_file = os.path.join(self.processed_path, f"{split}_data.npz")
+        labels = np.array([label for _, label in tasks], dtype=np.int64)
+        if not self.save_processed:
+            print(f"Preprocessing {split} data...")
+            buffer_file = f"{images_file}.{os.getpid()}.tmp"
+            self._decode_into_buffer(tasks, range(len(tasks)), buffer_file, split)
+            images = np.load(buffer_file)
+            os.remove(buffer_file)
+            return images, labels
 
-    def _preload_val_data(self):
-        val_names = self.raw_data.val_names()
-        val_labels = self.raw_data.val_labels()
-        tasks = [(os.path.join(self.raw_data.val_data_path(), "images", image_name), label) 
-                 for image_name, label in zip(val_names, val_labels)]
+        meta = self._source_meta(tasks)
+        old_meta = None
+        if not self.force_reload:
+            if not os.path.exists(images_file) and os.path.exists(legacy_file):
+                self._migrate_npz(legacy_file, images_file, labels_file)
+            if os.path.exists(images_file) and os.path.exists(labels_file):
+                old_meta = self._read_meta(meta_file, images_file, meta)
+
+        if old_meta is not None and self._same_meta(old_meta, meta):
+            print(f"Loading preprocessed {split} data from {images_file}...")
+            # labels come from the annotation files, which the image fingerprint does not cover
+            if not np.array_equal(np.load(labels_file), labels):
+                print(f"Updating {labels_file}, the annotations changed...")
+                save_npy(labels_file, labels)
+            return np.load(images_file, mmap_mode="r"), labels
+
+        buffer_file = f"{images_file}.{os.getpid()}.tmp"
+        images = np.lib.format.open_memmap(buffer_file, mode="w+", dtype=np.uint8,
+                                           shape=(len(tasks),) + IMAGE_SHAPE)
+        new_rows, old_rows = self._reusable_rows(old_meta, meta)
+        if len(new_rows) > 0:
+            print(f"Reusing {len(new_rows)} of {len(tasks)} preprocessed {split} images...")
+            old_images = np.load(images_file, mmap_mode="r")
+            for start in range(0, len(new_rows), 4096):
+                images[new_rows[start:start + 4096]] = old_images[old_rows[start:start + 4096]]
+            del old_images
+        images.flush()
+        del images  # the header and file size are written, workers fill in the remaining rows
+
+        stale = np.setdiff1d(np.arange(len(tasks)), new_rows)
+        print(f"Preprocessing {len(stale)} {split} images...")
+        self._decode_into_buffer(tasks, stale, buffer_file, split)
+
+        print(f"Saving preprocessed {split} data to {images_file}...")
+        save_npy(labels_file, labels)
+        os.replace(buffer_file, images_file)
+        # written last: after a crash the old fingerprint no longer matches and the rows are redone
+        self._write_meta(meta_file, meta)
+        return np.load(images_file, mmap_mode="r"), labels
+
+    def _source_meta(self, tasks):
+        """Preprocessing parameters and (path relative to the data dir, size, mtime_ns) of every source image."""
+        stats = [os.stat(image_path) for image_path, _ in tasks]
+        return {
+            "params": np.array(f"v{CACHE_VERSION} rgb uint8 {'x'.join(map(str, IMAGE_SHAPE))}"),
+            "paths": np.array([os.path.relpath(image_path, self.raw_data.data_path) for image_path, _ in tasks]),
+            "sizes": np.array([st.st_size for st in stats], dtype=np.int64),
+            "mtimes": np.array([st.st_mtime_ns for st in stats], dtype=np.int64),
+        }
+
+    @staticmethod
+    def _same_meta(old_meta, meta):
+        return all(np.array_equal(old_meta[key], meta[key]) for key in meta)
+
+    @staticmethod
+    def _read_meta(meta_file, images_file, meta):
+        """
+        Fingerprint of an existing cache. A cache written before fingerprints were recorded
+        is adopted as is when its row count matches the current source files.
+        """
+        if os.path.exists(meta_file):
+            with np.load(meta_file) as data:
+                return {key: data[key] for key in data.files}
+        if len(np.load(images_file, mmap_mode="r")) == len(meta["paths"]):
+            print(f"Recording the source fingerprint of {images_file}...")
+            TinyImageNetDataset._write_meta(meta_file, meta)
+            return meta
+        return None
+
+    @staticmethod
+    def _write_meta(meta_file, meta):
+        tmp_path = f"{meta_file}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **meta)
+        os.replace(tmp_path, meta_file)
+
+    @staticmethod
+    def _reusable_rows(old_meta, meta):
+        """Rows (new, old) whose source image is unchanged, given the preprocessing parameters match."""
+        if old_meta is None or old_meta["params"] != meta["params"]:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        old_rows = {key: row for row, key in
+                    enumerate(zip(old_meta["paths"].tolist(), old_meta["sizes"].tolist(), old_meta["mtimes"].tolist()))}
+        pairs = [(row, old_rows[key]) for row, key in
+                 enumerate(zip(meta["paths"].tolist(), meta["sizes"].tolist(), meta["mtimes"].tolist()))
+                 if key in old_rows]
+        rows = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        return rows[:, 0], rows[:, 1]
+
+    @staticmethod
+    def _migrate_npz(legacy_file, images_file, labels_file):
+        """Convert a cache written by np.savez into the memory-mappable .npy layout."""
+        print(f"Migrating {legacy_file} to {images_file}...")
+        with np.load(legacy_file) as data:
+            save_npy(labels_file, np.asarray(data["labels"], dtype=np.int64))
+            save_npy(images_file, np.ascontiguousarray(data["images"], dtype=np.uint8))
+        print(f"Migration done, {legacy_file} is no longer used and can be removed.")
+
+    def _train_tasks(self):
+        return self.raw_data.train_items()
+
+    def _val_tasks(self):
+        return self.raw_data.val_items()
+
+    @staticmethod
+    def _decode_into_buffer(tasks, rows, buffer_file, desc):
+        """
+        Decode the images of tasks[i] for i in rows straight into row i of a memory-mapped .npy
+        file, so decoded images never travel back through the parent process.
+        The buffer is created (for all tasks) unless it exists already.
+        """
+        if not os.path.exists(buffer_file):
+            # the header and file size are written, the map is dropped right away; workers fill in the rows
+            np.lib.format.open_memmap(buffer_file, mode="w+", dtype=np.uint8,
+                                      shape=(len(tasks),) + IMAGE_SHAPE)
+        if len(rows) == 0:
+            return
 
         num_workers = min(cpu_count(), 16)
-        print(f"Using {num_workers} workers for multiprocessing (val)...")
-        with Pool(processes=num_workers) as pool:
-            results = pool.map(load_image_multiprocess, tasks)
+        # large enough chunks to amortize IPC, small enough to keep all workers busy till the end
+        chunksize = max(1, min(256, len(rows) // (num_workers * 8)))
+        print(f"Using {num_workers} workers for multiprocessing ({desc})...")
+        index_tasks = [(i, tasks[i][0]) for i in rows]
+        with Pool(processes=num_workers, initializer=init_image_buffer, initargs=(buffer_file,)) as pool:
+            for _ in tqdm(pool.imap_unordered(load_image_into_buffer, index_tasks, chunksize=chunksize),
+                          total=len(index_tasks), desc=f"Decode {desc}"):
+                pass
+
+    def __getstate__(self):
+        # with the spawn start method (always on Windows) DataLoader pickles the dataset into
+        # every worker, and a memmap pickles as a full in-memory copy; send the path instead
+        state = self.__dict__.copy()
+        if state["images_file"] is not None:
+            state["images"] = None
+        return state
 
-        val_images, val_labels = zip(*results)
-        val_labels = np.array(val_labels)
-        return val_images, val_labels
+    def _image_array(self):
+        if self.images is None and self.images_file is not None:
+            self.images = np.load(self.images_file, mmap_mode="r")
+        return self.images
+
+    def _load_image(self, index):
+        if not self.lazy:
+            # copy out of the read-only memory map, transforms expect a writable array
+            return np.array(self._image_array()[index])
+        image = self.cache.get(index)
+        if image is None:
+            image, _ = load_image_multiprocess((self.paths[index], None))
+            self.cache.put(index, image)
+        # the cached array must not be modified by the transforms
+        return image.copy()
+
+    def cache_info(self):
+        """Hit/miss counters and size of the decoded-image cache over all loader workers (lazy mode only)."""
+        return self.cache.info() if self.lazy else None
 
     def __getitem__(self, index):
         label = self.labels[index]
-        image = self.images[index]
+        image = self._load_image(index)
         return self.transform(image), label
 
+    def __getitems__(self, indices):
+        """
+        Batched fetch used by DataLoader, also through the Subsets of random_split.
+        Without a per-sample transform (ToUint8Tensor) the whole batch is gathered from the
+        image array with a single fancy-index call; use collate_batch as the collate_fn.
+        Samples come back in ascending index order, which keeps reads of the memory map sequential.
+        """
+        if isinstance(self.transform, ToUint8Tensor):
+            indices = np.sort(np.asarray(indices))
+            if self.lazy:
+                images = torch.from_numpy(np.stack([self._load_image(index) for index in indices]))
+            else:
+                images = torch.from_numpy(self._image_array()[indices])
+            labels = torch.from_numpy(self.labels[indices])
+            return images, labels
+        return [self[index] for index in indices]
+
     def __len__(self):
         return len(self.labels)
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""
+Background prefetching of DataLoader batches.
+
+A thread keeps the next K batches collated, pinned and already copied to the
+device, so the host-to-device transfer of batch i+1 overlaps the training step
+of batch i. On CUDA the copies are issued on a side stream; the step loop only
+waits on an event recorded after each copy.
+"""
+import time
+import queue
+import threading
+from contextlib import nullcontext
+import torch
+
+
+class _Stop:
+    """Sentinel put into the queue when the wrapped loader is exhausted."""
+
+
+class DataPrefetcher:
+    def __init__(self, loader, device, num_prefetch=2, time_copies=False):
+        """
+        Wrap an iterable of (x, y) batches.
+
+        Parameters:
+        - loader: DataLoader (or any iterable of tensor tuples)
+        - device: device the batches are moved to
+        - num_prefetch (int): number of batches kept ready ahead of the step loop
+        - time_copies (bool): time the pinning and host-to-device copy of every batch
+          (CUDA events on the side stream); `copy_time` then holds the seconds of the copy
+          of the batch handed out last
+
+        Iterating yields (x, y) on `device`. After (or during) an epoch, `wait_time` holds the
+        seconds the step loop spent blocked on data and `num_batches` the batches handed out.
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        if self.device.type == "cuda" and self.device.index is None:
+            # the worker thread has its own current device, pin it to the one of the caller
+            self.device = torch.device("cuda", torch.cuda.current_device())
+        self.num_prefetch = max(1, num_prefetch)
+        self.time_copies = time_copies
+        self.copy_time = None
+        self.wait_time = 0.0
+        self.num_batches = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    def _to_device(self, batch, stream):
+        pin = self.device.type == "cuda"
+        start = None
+        if self.time_copies:
+            start = torch.cuda.Event(enable_timing=True) if stream is not None else time.perf_counter()
+            if stream is not None:
+                start.record(stream)
+        with torch.cuda.stream(stream) if stream is not None else nullcontext():
+            moved = []
+            for t in batch:
+                if pin and not t.is_pinned():
+                    t = t.pin_memory()
+                moved.append(t.to(self.device, non_blocking=True))
+        event = None
+        if stream is not None:
+            event = torch.cuda.Event(enable_timing=self.time_copies)
+            event.record(stream)
+        elif self.time_copies:
+            start = time.perf_counter() - start
+        return moved, event, start
+
+    def _worker(self, batches, stop):
+        try:
+            stream = None
+            if self.device.type == "cuda":
+                torch.cuda.set_device(self.device)
+                stream = torch.cuda.Stream(self.device)
+            for batch in self.loader:
+                item = self._to_device(batch, stream)
+                while not stop.is_set():
+                    try:
+                        batches.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            item = _Stop
+        except Exception as e:  # re-raised in the step loop
+            item = e
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    @staticmethod
+    def _get(batches, thread):
+        while True:
+            try:
+                return batches.get(timeout=1.0)
+            except queue.Empty:
+                # the worker always queues _Stop or its exception before it exits
+                if not thread.is_alive() and batches.empty():
+                    raise RuntimeError("DataPrefetcher worker thread died without a result")
+
+    def __iter__(self):
+        self.wait_time = 0.0
+        self.num_batches = 0
+        batches = queue.Queue(maxsize=self.num_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self._get(batches, thread)
+                self.wait_time += time.perf_counter() - start
+                if item is _Stop:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                moved, event, start = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # the tensors were allocated on the side stream, keep them alive for this one
+                    for t in moved:
+                        t.record_stream(current)
+                if self.time_copies:
+                    if event is not None:
+                        # reading the timing needs the copy to be done
+                        event.synchronize()
+                        start = start.elapsed_time(event) / 1000
+                    self.copy_time = start
+                self.num_batches += 1
+                yield tuple(moved)
+        finally:
+            stop.set()
+            thread.join()
+
+
+def prefetch(loader, device, num_prefetch=2, time_copies=False):
+    """Wrap loader in a DataPrefetcher unless it is one already."""
+    if isinstance(loader, DataPrefetcher):
+        return loader
+    return DataPrefetcher(loader, device, num_prefetch=num_prefetch, time_copies=time_copies)
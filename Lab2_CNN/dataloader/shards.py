@@ -0,0 +1,244 @@
+"""
+Sharded sequential record format for streaming image datasets from disk.
+
+A split is stored as N shard files `{split}-{i:05d}.shard`. A shard is a plain
+concatenation of records, each a little-endian (int32 label, uint32 length)
+header followed by the encoded image bytes exactly as they were on disk.
+Next to every shard an index `{split}-{i:05d}.idx.npy` holds one int64 row
+(payload offset, payload length, label) per record; readers check every record
+against it, so a shard and an index that do not belong together are detected.
+
+Reading a shard is one sequential scan of a large file instead of one random
+open/read per JPEG; ShardedImageDataset streams the shards with shard-level
+shuffling plus an in-memory shuffle buffer.
+
+Usage:
+    python -m dataloader.shards -d ./data/tiny-imagenet-200 --num-shards 64
+"""
+import os
+import glob
+import struct
+import random
+import argparse
+import numpy as np
+import cv2
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+import torchvision.transforms as transforms
+from tqdm import tqdm
+
+RECORD_HEADER = struct.Struct("<iI")
+
+
+def shard_paths(shard_dir, split):
+    return sorted(glob.glob(os.path.join(shard_dir, f"{split}-*.shard")))
+
+
+def index_path(shard_path):
+    return shard_path[:-len(".shard")] + ".idx.npy"
+
+
+def write_shards(items, shard_dir, split, num_shards, seed=0):
+    """
+    Pack items [(image path, label), ...] into num_shards shard files.
+
+    The items are shuffled once before they are dealt to the shards, so every shard
+    holds a mix of classes even when items are grouped by class. Shards differ in
+    size by at most one record. Returns the list of shard paths.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    for old_path in shard_paths(shard_dir, split):
+        os.remove(old_path)
+        if os.path.exists(index_path(old_path)):
+            os.remove(index_path(old_path))
+
+    order = np.random.default_rng(seed).permutation(len(items))
+    num_shards = max(1, min(num_shards, len(items)))
+    paths = []
+    with tqdm(total=len(items), desc=f"Write {split} shards") as pbar:
+        for shard_id in range(num_shards):
+            path = os.path.join(shard_dir, f"{split}-{shard_id:05d}.shard")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            shard_items = order[shard_id::num_shards]
+            index = np.empty((len(shard_items), 3), dtype=np.int64)
+            with open(tmp_path, "wb") as f:
+                for row, item_id in enumerate(shard_items):
+                    image_path, label = items[item_id]
+                    with open(image_path, "rb") as image_file:
+                        payload = image_file.read()
+                    f.write(RECORD_HEADER.pack(int(label), len(payload)))
+                    index[row] = (f.tell(), len(payload), label)
+                    f.write(payload)
+                    pbar.update(1)
+            np.save(index_path(path), index)
+            # the shard only appears under its name once it and its index are complete
+            os.replace(tmp_path, path)
+            paths.append(path)
+    return paths
+
+
+def read_shard(path, index=None):
+    """
+    Yield (label, encoded bytes) of every record of a shard in file order.
+    index: the rows of the shard's .idx.npy; every record must match its row and the
+    shard must hold exactly len(index) records.
+    """
+    with open(path, "rb", buffering=2 ** 20) as f:
+        row = 0
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if not header:
+                break
+            if len(header) != RECORD_HEADER.size:
+                raise ValueError(f"Truncated record header in {path}")
+            label, length = RECORD_HEADER.unpack(header)
+            if index is not None and (row >= len(index) or tuple(index[row]) != (f.tell(), length, label)):
+                raise ValueError(f"Record {row} of {path} does not match {index_path(path)}")
+            payload = f.read(length)
+            if len(payload) != length:
+                raise ValueError(f"Truncated record in {path}")
+            row += 1
+            yield label, payload
+        if index is not None and row != len(index):
+            raise ValueError(f"{path} holds {row} records, {index_path(path)} lists {len(index)}")
+
+
+def decode_image(payload):
+    """Encoded image bytes -> uint8 RGB array [H, W, 3]."""
+    image = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)  # BGR
+    if image is None:
+        raise ValueError("Could not decode image record")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class ShardedImageDataset(IterableDataset):
+    def __init__(self, shard_dir, split, transform=None, shuffle=True, buffer_size=4096, seed=0,
+                 num_workers=0, rank=None, world_size=None, drop_last=None):
+        """
+        Stream (image, label) samples from the shards of one split.
+
+        Parameters:
+        - shard_dir (str): directory written by write_shards
+        - split (str): 'train' or 'val'
+        - transform: per-sample transform applied to the decoded uint8 [H, W, 3] array
+        - shuffle (bool): shuffle the shard order every epoch and pass samples through a shuffle buffer
+        - buffer_size (int): number of samples held (still encoded) by the shuffle buffer of each worker
+        - num_workers (int): num_workers of the DataLoader, used by __len__
+        - rank, world_size: DDP position, taken from torch.distributed when it is initialized
+        - drop_last (bool): every worker of every rank yields the same number of samples, so
+          DDP ranks never wait on each other at the end of an epoch; default True for the
+          'train' split only, evaluation sees every sample
+
+        Shards are dealt round-robin to all (rank, worker) pairs; call set_epoch before every
+        epoch to get a new shard order (same seed on all ranks keeps the split disjoint).
+        With drop_last there must be at least world_size * num_workers shards; without it,
+        consumers left without a shard simply yield nothing.
+        """
+        self.shards = shard_paths(shard_dir, split)
+        if not self.shards:
+            raise FileNotFoundError(f"No {split} shards found in {shard_dir}")
+        self.sizes = [len(np.load(index_path(path), mmap_mode="r")) for path in self.shards]
+        self.transform = transforms.ToTensor() if transform is None else transform
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.drop_last = split == "train" if drop_last is None else drop_last
+        self.num_workers = max(1, num_workers)
+        if rank is None or world_size is None:
+            initialized = dist.is_available() and dist.is_initialized()
+            rank = dist.get_rank() if initialized else 0
+            world_size = dist.get_world_size() if initialized else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _shard_order(self):
+        order = list(range(len(self.shards)))
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(order)
+        return order
+
+    def _assignment(self, num_workers):
+        """Shard ids of every (rank, worker) consumer, consumer c = rank * num_workers + worker."""
+        num_consumers = self.world_size * num_workers
+        if self.drop_last and len(self.shards) < num_consumers:
+            raise ValueError(f"{len(self.shards)} shards cannot feed {self.world_size} ranks x "
+                             f"{num_workers} workers, write at least {num_consumers} shards")
+        order = self._shard_order()
+        return [order[consumer::num_consumers] for consumer in range(num_consumers)]
+
+    def _samples_per_consumer(self, assignment):
+        """Per-consumer sample limit, or None when every consumer reads its shards completely."""
+        if not self.drop_last:
+            return None
+        return min(sum(self.sizes[i] for i in shards) for shards in assignment)
+
+    def _records(self, shards, limit):
+        count = 0
+        for shard_id in shards:
+            index = np.load(index_path(self.shards[shard_id]), mmap_mode="r")
+            for record in read_shard(self.shards[shard_id], index):
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield record
+
+    def _samples(self, shards, limit, consumer):
+        rng = random.Random(self.seed + 1000003 * (self.epoch + 1) + consumer)
+        buffer = []
+        for label, payload in self._records(shards, limit):
+            if not self.shuffle:
+                yield payload, label
+            elif len(buffer) < self.buffer_size:
+                buffer.append((payload, label))
+            else:
+                # emit a random buffered sample and put the new one in its place
+                j = rng.randrange(len(buffer))
+                buffer[j], sample = (payload, label), buffer[j]
+                yield sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker = get_worker_info()
+        num_workers, worker_id = (1, 0) if worker is None else (worker.num_workers, worker.id)
+        assignment = self._assignment(num_workers)
+        limit = self._samples_per_consumer(assignment)
+        consumer = self.rank * num_workers + worker_id
+        for payload, label in self._samples(assignment[consumer], limit, consumer):
+            # buffered samples stay encoded, decoding happens once on the way out
+            yield self.transform(decode_image(payload)), label
+
+    def __len__(self):
+        """Samples this rank yields per epoch."""
+        assignment = self._assignment(self.num_workers)
+        limit = self._samples_per_consumer(assignment)
+        consumers = assignment[self.rank * self.num_workers:(self.rank + 1) * self.num_workers]
+        if limit is not None:
+            return limit * len(consumers)
+        return sum(self.sizes[i] for shards in consumers for i in shards)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser(description="Convert Tiny ImageNet into shard files", add_help=True)
+    parser.add_argument('-d', "--data-path", type=str, default="./data/tiny-imagenet-200", help="Path to the Tiny ImageNet data")
+    parser.add_argument('-o', "--out-dir", type=str, default=None, help="output directory (default: <data-path>/shards)")
+    # training drops samples to balance consumers and needs a shard for each of them
+    parser.add_argument("--num-shards", type=int, default=64, help="number of training shards, at least DDP ranks x loader workers")
+    parser.add_argument("--num-val-shards", type=int, default=8, help="number of validation shards (idle consumers are allowed)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the shuffle before sharding")
+    return parser
+
+
+if __name__ == "__main__":
+    from .dataset import RawData
+    args = get_args_parser().parse_args()
+    raw_data = RawData(args.data_path)
+    out_dir = os.path.join(args.data_path, "shards") if args.out_dir is None else args.out_dir
+    for split, items, num_shards in [("train", raw_data.train_items(), args.num_shards),
+                                     ("val", raw_data.val_items(), args.num_val_shards)]:
+        paths = write_shards(items, out_dir, split, num_shards, seed=args.seed)
+        print(f"{split}: {len(items)} images in {len(paths)} shards under {out_dir}")
@@ -1,6 +1,15 @@
+import os
+import multiprocessing
+from collections import OrderedDict
 import cv2
+import numpy as np
 import torch
 
+IMAGE_SHAPE = (64, 64, 3)
+
+# memory-mapped output array of the current worker process, see init_image_buffer
+_image_buffer = None
+
 def load_image_multiprocess(args):
     """Single image loading function for use with multiprocessing."""
     image_path, label = args
@@ -10,6 +19,20 @@ def load_image_multiprocess(args):
     image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)  # Convert to RGB
     return image, label
 
+def init_image_buffer(buffer_file):
+    """Pool initializer: open the preallocated .npy image buffer for writing in this worker."""
+    global _image_buffer
+    _image_buffer = np.load(buffer_file, mmap_mode="r+")
+
+def load_image_into_buffer(args):
+    """Decode one image and write it into row `index` of the worker's image buffer."""
+    index, image_path = args
+    image, _ = load_image_multiprocess((image_path, None))
+    if image.shape != _image_buffer.shape[1:]:
+        raise ValueError(f"Image {image_path} has shape {image.shape}, expected {_image_buffer.shape[1:]}")
+    _image_buffer[index] = image
+    return index
+
 def apply_transform_multiprocess(args):
     """
     Single image transformation function for use with multiprocessing.
@@ -17,3 +40,63 @@ def apply_transform_multiprocess(args):
     img, transform = args
     img_pil = Image.fromarray(img)  # 转换为 PIL Image
     return transform(img_pil)
+
+
+def save_npy(path, array):
+    """Write an array as a raw .npy file; the file only appears under `path` once it is complete."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+class LRUImageCache:
+    """
+    Least-recently-used cache of decoded images, bounded by the total bytes of the cached arrays.
+
+    Every DataLoader worker holds its own copy of the cache, but the counters live in shared
+    memory created with the cache: info() in the main process reports the sum over all workers.
+    """
+    COUNTERS = ("hits", "misses", "evictions", "items", "bytes")
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0  # of the copy in this process
+        self.counters = multiprocessing.Array("q", len(self.COUNTERS))
+        self._items = OrderedDict()
+
+    def _add(self, **deltas):
+        with self.counters.get_lock():
+            for name, delta in deltas.items():
+                self.counters[self.COUNTERS.index(name)] += delta
+
+    def get(self, key):
+        image = self._items.get(key)
+        if image is None:
+            self._add(misses=1)
+            return None
+        self._items.move_to_end(key)
+        self._add(hits=1)
+        return image
+
+    def put(self, key, image):
+        if image.nbytes > self.max_bytes or key in self._items:
+            return
+        self._items[key] = image
+        self.bytes += image.nbytes
+        added, freed, evictions = image.nbytes, 0, 0
+        while self.bytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.bytes -= evicted.nbytes
+            freed += evicted.nbytes
+            evictions += 1
+        self._add(items=1 - evictions, bytes=added - freed, evictions=evictions)
+
+    def info(self):
+        """Counters summed over all processes sharing this cache; items and bytes are totals of all copies."""
+        with self.counters.get_lock():
+            info = dict(zip(self.COUNTERS, self.counters[:]))
+        total = info["hits"] + info["misses"]
+        info["hit_rate"] = info["hits"] / total if total > 0 else 0.0
+        info["max_bytes"] = self.max_bytes
+        return info
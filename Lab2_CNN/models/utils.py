@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import copy
 import numpy as np
 def get_sinusoid_encoding(n_position, d_hid):
     ''' Sinusoid position encoding table '''
@@ -24,4 +25,56 @@ def trunc_normal(tensor, mean=0., std=1., a=-2., b=2.):
             mask = (tensor < a) | (tensor > b)
             if not mask.any():
                 break
-            tensor[mask] = torch.normal(mean, std, size=mask.sum().item())
\ No newline at end of file
+            tensor[mask] = torch.normal(mean, std, size=mask.sum().item())
+
+def fold_conv_bn(conv, bn):
+    """Conv2d equivalent to bn(conv(x)) with bn in eval mode, i.e. using its running statistics."""
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True,
+                      padding_mode=conv.padding_mode).to(conv.weight.device, conv.weight.dtype)
+    with torch.no_grad():
+        # every output channel is scaled on its own, so grouped convs need no special handling
+        scale = torch.rsqrt(bn.running_var + bn.eps)
+        shift = -bn.running_mean * scale
+        if bn.affine:
+            scale = scale * bn.weight
+            shift = shift * bn.weight + bn.bias
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+        fused.bias.copy_(bias * scale + shift)
+    return fused
+
+
+def _foldable(conv, bn):
+    return (isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d)
+            and bn.running_mean is not None and conv.out_channels == bn.num_features)
+
+
+def _fuse_children(module):
+    children = dict(module.named_children())
+    if isinstance(module, nn.Sequential):
+        # VGG features and the ResNet shortcuts: a conv directly followed by its BN
+        names = list(children)
+        pairs = [(a, b) for a, b in zip(names, names[1:]) if _foldable(children[a], children[b])]
+    else:
+        # ResNet stem and blocks: convN feeds bnN in forward()
+        pairs = [(f"conv{name[2:]}", name) for name in children
+                 if name.startswith("bn") and _foldable(children.get(f"conv{name[2:]}"), children[name])]
+    for conv_name, bn_name in pairs:
+        setattr(module, conv_name, fold_conv_bn(children[conv_name], children[bn_name]))
+        setattr(module, bn_name, nn.Identity())
+    for child in module.children():
+        _fuse_children(child)
+
+
+def fuse_for_inference(model):
+    """
+    Copy of a VGG/ResNet/ResNeXt model with every BatchNorm2d folded into the conv before it.
+
+    The copy is in eval mode with gradients disabled; it computes the same function as
+    model.eval() with one conv per Conv->BN pair. Putting it back into train mode does not
+    bring the BN layers back, so it is only meant for inference.
+    """
+    fused = copy.deepcopy(model).eval()
+    _fuse_children(fused)
+    return fused.requires_grad_(False)
@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from tqdm import tqdm
-from torch.amp import autocast, GradScaler
+from torch.amp import GradScaler
 
 import numpy as np
 import random
@@ -18,7 +18,10 @@ from torch.utils.tensorboard import SummaryWriter
 from models.VGG import VGG
 from models.ResNet import ResNet
 from models.ViT import T2T_ViT
-from dataloader.dataset import TinyImageNetDataset, RawData
+from dataloader.dataset import TinyImageNetDataset, RawData, collate_batch, dataset_cache_info
+from dataloader.augment import ToUint8Tensor, build_device_transforms
+from dataloader.prefetch import DataPrefetcher, prefetch
+from checkpoint import CheckpointWriter, snapshot, restore, load_checkpoint, to_cpu, unwrap
 from config import *
 from utils import *
 
@@ -30,7 +33,7 @@ torch.manual_seed(SEED)
 torch.cuda.manual_seed(SEED)
 torch.backends.cudnn.deterministic = True
 
-def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False,workers=1, half=False):
+def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False,workers=1, half=False, batch_aug=False, uint8=False, lazy=False, cache_mb=512):
     """
     Prepare DataLoaders for training, validation, and testing.
 
@@ -38,6 +41,12 @@ def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False,work
         raw_data (RawData): Instance of the RawData class, providing data and labels.
         batch_size (int): Batch size for DataLoaders.
         val_ratio (float): Proportion of training data to use for validation.
+        batch_aug (bool): Training loader yields raw uint8 [B, 64, 64, 3] batches to be augmented
+            by BatchAugmentation in the training step instead of per-sample PIL transforms.
+        uint8 (bool): All loaders yield uint8 [B, 64, 64, 3] batches; conversion and normalization
+            run once per batch in the training step (see build_device_transforms).
+        lazy (bool): Decode images on access instead of preloading them, with an LRU cache
+            of cache_mb MiB in every loader worker.
 
     Returns:
         train_loader, val_loader, test_loader
@@ -50,7 +59,16 @@ def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False,work
     normalize = transforms.Normalize(mean=[0.4802, 0.4481, 0.3975],
                                      std=[0.2302, 0.2265, 0.2262])
     print("Loading training data")
-    if half:
+    if batch_aug:
+        train_transform = ToUint8Tensor()
+    elif uint8:
+        train_transform = transforms.Compose([
+            transforms.ToPILImage(),
+            transforms.RandomResizedCrop(64),
+            transforms.RandomHorizontalFlip(),
+            ToUint8Tensor(),
+        ])
+    elif half:
         train_transform = transforms.Compose([
             transforms.ToPILImage(),
             transforms.RandomResizedCrop(64),
@@ -69,17 +87,20 @@ def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False,work
 
             ])
 
-    test_transform = transforms.Compose([
-                           transforms.ToTensor(),
-                            normalize
-                       ])
+    if batch_aug or uint8:
+        test_transform = ToUint8Tensor()
+    else:
+        test_transform = transforms.Compose([
+                               transforms.ToTensor(),
+                                normalize
+                           ])
 
     # Create the test dataset from the validation data in the original dataset
-    test_dataset = TinyImageNetDataset(type_='val', raw_data=raw_data, transform=test_transform, force_reload=force_reload)
+    test_dataset = TinyImageNetDataset(type_='val', raw_data=raw_data, transform=test_transform, lazy=lazy, cache_bytes=cache_mb * 2 ** 20, force_reload=force_reload)
     print("Validation dataset created, size: ", len(test_dataset))
 
     # Create the full training dataset from the original training data
-    full_train_dataset = TinyImageNetDataset(type_='train', raw_data=raw_data, transform=train_transform, force_reload=force_reload)
+    full_train_dataset = TinyImageNetDataset(type_='train', raw_data=raw_data, transform=train_transform, lazy=lazy, cache_bytes=cache_mb * 2 ** 20, force_reload=force_reload)
     print("Full training dataset created, size: ", len(full_train_dataset))
 
     # Calculate the sizes of the new training and validation sets
@@ -91,36 +112,52 @@ def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False,work
     train_dataset, val_dataset = random_split(full_train_dataset, [train_size, val_size])
 
     # Create DataLoaders for train, validation, and test datasets
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True,  pin_memory=True, num_workers=workers)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True,  pin_memory=True, num_workers=workers, persistent_workers=lazy and workers > 0, collate_fn=collate_batch)
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers, persistent_workers=lazy and workers > 0, collate_fn=collate_batch)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers, persistent_workers=lazy and workers > 0, collate_fn=collate_batch)
 
     print("DataLoaders created.")
 
     return train_loader, val_loader, test_loader
 
-def train(model, iterator, optimizer, criterion, device='cpu', scaler=None, writer=None):
-    epoch_loss = 0
-    epoch_acc = 0
+def train(model, iterator, optimizer, criterion, device='cpu', scaler=None, writer=None, preprocess=None, timer=None, log_every=50, step=0, amp_dtype=None, memory_format=None):
+    """
+    One training epoch. Metrics are read back from the device every log_every steps;
+    step is the global step of the first batch, used for TensorBoard.
+    amp_dtype is the autocast dtype (see autocast_dtype), None trains in fp32.
+    """
+    iterator = prefetch(iterator, device)
+    timer = StepTimer() if timer is None else timer
+    metrics = MetricAccumulator(device)
     model.train()
+    timer.reset()
     with tqdm(total=len(iterator), desc='Train', leave=False) as t:
-        for i, (x,label) in enumerate(iterator):
-            x = x.to(device)
-            y = label.to(device)
+        for i, (x, y) in enumerate(iterator):
+            timer.mark('data')
+            timer.add('h2d', iterator.copy_time)
+            if preprocess is not None:
+                x = preprocess(x)
+            if memory_format is not None:
+                x = x.contiguous(memory_format=memory_format)
+            timer.mark('preprocess')
             optimizer.zero_grad()
 
-            with autocast('cuda'):
+            with autocast_context(device, amp_dtype):
                 y_pred, h = model(x)
                 loss = criterion(y_pred, y)
-                acc = calculate_accuracy(y_pred, y)
+            metrics.update(loss, y_pred, y)
+            timer.mark('forward')
             
             if scaler is not None:
                 scaler.scale(loss).backward()
+                timer.mark('backward')
                 scaler.step(optimizer)
                 scaler.update()
             else:
                 loss.backward()
+                timer.mark('backward')
                 optimizer.step()
+            timer.mark('optimizer')
 
 
             # y_pred, h = model(x)
@@ -130,70 +167,130 @@ def train(model, iterator, optimizer, criterion, device='cpu', scaler=None, writ
             # optimizer.step()
 
 
-            epoch_loss += loss.item()
-            epoch_acc += acc.item()
-            t.set_postfix(loss=epoch_loss / (i + 1), acc=epoch_acc / (i + 1))
-            if writer is not None:
-                writer.add_scalar('Loss/train', loss.item(), i)
-                writer.add_scalar('Accuracy/train', acc.item(), i)
+            if (i + 1) % log_every == 0 or i + 1 == len(iterator):
+                (window_loss, window_acc), (epoch_loss, epoch_acc) = metrics.flush()
+                t.set_postfix(loss=epoch_loss, acc=epoch_acc)
+                if writer is not None:
+                    writer.add_scalar('Loss/train', window_loss, step + i)
+                    writer.add_scalar('Accuracy/train', window_acc, step + i)
             t.update(1)
-    return epoch_loss / len(iterator), epoch_acc / len(iterator)
+            timer.mark('logging')
+    return metrics.mean()
 
-def evaluate(model, iterator, criterion, device='cpu', writer=None):
-    epoch_loss = 0
-    epoch_acc = 0
+def evaluate(model, iterator, criterion, device='cpu', writer=None, preprocess=None, log_every=50, step=None, amp_dtype=None, memory_format=None):
+    """Evaluate on the whole loader; with a writer the means are logged at the global step `step`."""
+    iterator = prefetch(iterator, device)
+    metrics = MetricAccumulator(device)
     model.eval()
     with torch.no_grad():
         with tqdm(total=len(iterator), desc='Eval', leave=False) as t:
-            for i, (x, label) in enumerate(iterator):
-                x = x.to(device)
-                y = label.to(device)
-                with autocast('cuda'):
+            for i, (x, y) in enumerate(iterator):
+                if preprocess is not None:
+                    x = preprocess(x)
+                if memory_format is not None:
+                    x = x.contiguous(memory_format=memory_format)
+                with autocast_context(device, amp_dtype):
                     y_pred, h = model(x)
                     loss = criterion(y_pred, y)
-                    acc = calculate_accuracy(y_pred, y)
+                metrics.update(loss, y_pred, y)
                 # y_pred, h = model(x)
                 # loss = criterion(y_pred, y)
                 # acc = calculate_accuracy(y_pred, y)
-                epoch_loss += loss.item()
-                epoch_acc += acc.item()
-                t.set_postfix(loss=epoch_loss / (i + 1), acc=epoch_acc / (i + 1))
-                if writer is not None:
-                    writer.add_scalar('Loss/val', loss.item(), i)
-                    writer.add_scalar('Accuracy/val', acc.item(), i)
+                if (i + 1) % log_every == 0 or i + 1 == len(iterator):
+                    _, (epoch_loss, epoch_acc) = metrics.flush()
+                    t.set_postfix(loss=epoch_loss, acc=epoch_acc)
                 t.update(1)
 
-    return epoch_loss / len(iterator), epoch_acc / len(iterator)
+    epoch_loss, epoch_acc = metrics.mean()
+    if writer is not None and step is not None:
+        writer.add_scalar('Loss/val', epoch_loss, step)
+        writer.add_scalar('Accuracy/val', epoch_acc, step)
+    return epoch_loss, epoch_acc
+
+def train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, scheduler=None, save_dir=None, device='cpu', writer=None, half=False, train_preprocess=None, eval_preprocess=None, num_prefetch=2, time_steps=False, log_every=50, checkpoint_every=1, resume=False, amp_dtype=None, memory_format=None):
+    """
+    Train for num_epochs epochs and save the weights with the best validation accuracy.
 
-def train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, scheduler=None, save_dir=None, device='cpu', writer=None, half=False):
+    With a save_dir, the full training state is checkpointed to save_dir/checkpoints:
+    last.pth every checkpoint_every epochs and best.pth on every new best validation
+    accuracy, written in the background. With resume=True training continues after
+    the epoch stored in last.pth.
+    """
     log_history = {'train_loss': [], 'train_acc': [], 'val_loss': [], 'val_acc': []}
+    timer = StepTimer(enabled=time_steps, device=device)
+    step_timing = []
     model = model.to(device)
-    best_parms = model.state_dict()
+    # batches are prepared and copied to the device in the background, see DataPrefetcher
+    train_batches = DataPrefetcher(train_loader, device, num_prefetch=num_prefetch, time_copies=time_steps)
+    val_batches = DataPrefetcher(val_loader, device, num_prefetch=num_prefetch)
+    # a CPU copy, model.state_dict() alone would alias the live weights
+    best_parms = to_cpu(unwrap(model).state_dict())
     best_acc  = 0.0
     scaler = GradScaler('cuda') if half else None
+    start_epoch = 0
+    checkpoints = CheckpointWriter(os.path.join(save_dir, "checkpoints")) if save_dir is not None else None
+    if resume and checkpoints is not None and os.path.exists(checkpoints.path("last")):
+        state = load_checkpoint(checkpoints.path("last"))
+        start_epoch = restore(state, model, optimizer, scheduler, scaler)
+        best_acc = state['best_acc']
+        # the saving run may have been started without --time-steps; None marks untimed epochs
+        step_timing = state['log_history'].get('step_timing', [])
+        step_timing += [None] * (start_epoch - len(step_timing))
+        if os.path.exists(checkpoints.path("best")):
+            best_parms = load_checkpoint(checkpoints.path("best"))['model']
+        print(f"Resuming from {checkpoints.path('last')} at epoch {start_epoch}")
+    elif resume:
+        print("No checkpoint to resume from, starting from scratch")
     print("Training model on device: ", device)
-    with tqdm(total=num_epochs) as pbar:
-        for epoch in range(num_epochs):
+    with tqdm(total=num_epochs, initial=start_epoch) as pbar:
+        for epoch in range(start_epoch, num_epochs):
             # Train
-            train_loss, train_acc = train(model, train_loader, optimizer, criterion, device=device, scaler=scaler, writer=writer)
+            step = epoch * len(train_batches)
+            train_loss, train_acc = train(model, train_batches, optimizer, criterion, device=device, scaler=scaler, writer=writer, preprocess=train_preprocess, timer=timer, log_every=log_every, step=step, amp_dtype=amp_dtype, memory_format=memory_format)
+            if time_steps:
+                step_timing.append(timer.summary())
+                if writer is not None:
+                    StepTimer.write_summary(writer, step_timing[-1], epoch)
             if scheduler is not None:
                 scheduler.step()
             # Validate
-            valid_loss, valid_acc = evaluate(model, val_loader, criterion, device=device, writer=writer)
+            valid_loss, valid_acc = evaluate(model, val_batches, criterion, device=device, writer=writer, preprocess=eval_preprocess, log_every=log_every, step=step + len(train_batches), amp_dtype=amp_dtype, memory_format=memory_format)
 
-            pbar.set_postfix(train_loss=train_loss, valid_loss=valid_loss)
+            pbar.set_postfix(train_loss=train_loss, valid_loss=valid_loss, data_wait=train_batches.wait_time)
+            if writer is not None:
+                writer.add_scalar('DataWait/train', train_batches.wait_time, epoch)
+                writer.add_scalar('DataWait/val', val_batches.wait_time, epoch)
+            # train and val are splits of one dataset, they share the image cache
+            cache_info = dataset_cache_info(train_loader.dataset)
+            if cache_info is not None:
+                log_cache_info(cache_info, epoch, writer)
 
             # Save the best model
-            if valid_acc > best_acc:
+            is_best = valid_acc > best_acc
+            if is_best:
                 best_acc = valid_acc
-                best_parms = model.state_dict()
+            is_periodic = (epoch + 1) % checkpoint_every == 0 or epoch + 1 == num_epochs
+            if checkpoints is not None and (is_best or is_periodic):
+                state = snapshot(model, optimizer, scheduler, scaler, epoch=epoch, best_acc=best_acc,
+                                 log_history={'step_timing': step_timing})
+                if is_best:
+                    best_parms = state['model']
+                    checkpoints.save(state, "best")
+                if is_periodic:
+                    checkpoints.save(state, "last")
+            elif is_best:
+                best_parms = to_cpu(unwrap(model).state_dict())
 
             # log_history['train_loss'].append(train_loss)
             # log_history['train_acc'].append(train_acc)
             # log_history['val_loss'].append(valid_loss)
             # log_history['val_acc'].append(valid_acc)
             pbar.update(1)
+    if checkpoints is not None:
+        checkpoints.close()
     log_history = {}
+    if time_steps:
+        log_history['step_timing'] = step_timing
     if save_dir is not None:
         timestamp = time.strftime("%Y_%m_%d_%H_%M", time.localtime())
         save_path = os.path.join(save_dir, f"{timestamp}_model.pth")
@@ -241,6 +338,18 @@ def get_args_parser():
     parser.add_argument("--wo-skip", action="store_false", help="without skip connection in the model")
     parser.add_argument('--writer', action='store_true', help='write the log to tensorboard')
     parser.add_argument('--half', action='store_true', help='use half precision')
+    parser.add_argument('--precision', default='auto', type=str, choices=['auto', 'fp32', 'bf16', 'fp16'], help='autocast precision (auto: fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--batch-aug', action='store_true', help='augment whole uint8 batches on the device instead of per-sample PIL transforms')
+    parser.add_argument('--uint8', action='store_true', help='loaders yield uint8 batches, normalize once per batch on the device')
+    parser.add_argument('--lazy', action='store_true', help='decode images on access instead of preloading the dataset')
+    parser.add_argument('--cache-mb', default=512, type=int, help='LRU cache of decoded images per loader worker in lazy mode (MiB)')
+    parser.add_argument('--prefetch', default=2, type=int, help='number of batches prepared on the device ahead of the training step')
+    parser.add_argument('--time-steps', action='store_true', help='record per-phase step times (synchronizes the device)')
+    parser.add_argument('--log-every', default=50, type=int, help='read metrics back from the device every N steps')
+    parser.add_argument('--checkpoint-every', default=1, type=int, help='save the full training state every N epochs')
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint in the output directory')
+    parser.add_argument('--channels-last', action='store_true', help='keep the model and every batch in channels_last (NHWC) memory format')
+    parser.add_argument('--compile', action='store_true', help='wrap the model with torch.compile')
     parser.add_argument('--checkpoint', default=None, type=str, help='path to the checkpoint')
     return parser
 
@@ -256,8 +365,10 @@ def main(args):
 
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     print("Cuda available device counts = ", torch.cuda.device_count())
-    if not torch.cuda.is_available():
-        print("Eror: GPU is not available")
+    amp_dtype = autocast_dtype(device, args.precision)
+    print(f"Device: {device}, autocast dtype: {amp_dtype if amp_dtype is not None else 'fp32'}")
+    if args.half and amp_dtype != torch.float16:
+        print("Error: --half needs fp16 autocast on a GPU")
         sys.exit(1)
     # else:
     #     print_gpu_memory()
@@ -266,7 +377,7 @@ def main(args):
     num_classes = len(raw_data.labels_t())
     print(f"Number of classes: {num_classes}")
     # Create DataLoader objects
-    train_loader, val_loader, test_loader = DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=force_reload, workers=workers, half=args.half)
+    train_loader, val_loader, test_loader = DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=force_reload, workers=workers, half=args.half, batch_aug=args.batch_aug, uint8=args.uint8, lazy=args.lazy, cache_mb=args.cache_mb)
 
     # Create the model
     if args.model == "vgg11":
@@ -305,6 +416,13 @@ def main(args):
         model.load_state_dict(state_dict)
         print(f"Model loaded from {args.checkpoint}")
 
+    # NHWC lets cuDNN/oneDNN pick their faster conv kernels; the weights are converted in
+    # place, so the optimizer below still sees the same parameters
+    memory_format = torch.channels_last if args.channels_last else None
+    if memory_format is not None:
+        model = model.to(memory_format=memory_format)
+    if args.compile:
+        model = torch.compile(model)
     
     # Set up the optimizer
     if args.optimizer == "sgd":
@@ -362,10 +480,13 @@ def main(args):
     # Train the model
     save_dir = os.path.join(save_dir, args.model)
     os.makedirs(save_dir, exist_ok=True)
-    log_history = train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, scheduler=lr_scheduler, save_dir=save_dir, device=device, writer=writer, half=args.half)
+    train_preprocess, eval_preprocess = build_device_transforms(batch_aug=args.batch_aug, uint8=args.uint8)
+    if train_preprocess is not None:
+        train_preprocess, eval_preprocess = train_preprocess.to(device), eval_preprocess.to(device)
+    log_history = train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, scheduler=lr_scheduler, save_dir=save_dir, device=device, writer=writer, half=args.half, train_preprocess=train_preprocess, eval_preprocess=eval_preprocess, num_prefetch=args.prefetch, time_steps=args.time_steps, log_every=args.log_every, checkpoint_every=args.checkpoint_every, resume=args.resume, amp_dtype=amp_dtype, memory_format=memory_format)
 
     # Evaluate the model on test set
-    test_loss, test_acc = evaluate(model, test_loader, criterion, device)
+    test_loss, test_acc = evaluate(model, test_loader, criterion, device, preprocess=eval_preprocess, amp_dtype=amp_dtype, memory_format=memory_format)
     print(f"Test Loss: {test_loss:.4f}, Test Acc: {test_acc:.4f}")
 
     # Save the log history
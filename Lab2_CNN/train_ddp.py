@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from tqdm import tqdm
-from torch.amp import autocast, GradScaler
+from torch.amp import GradScaler
 
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
@@ -21,7 +21,10 @@ import json
 from models.VGG import VGG
 from models.ResNet import ResNet
 from models.ViT import T2T_ViT
-from dataloader.dataset import TinyImageNetDataset, RawData
+from dataloader.dataset import TinyImageNetDataset, RawData, collate_batch, dataset_cache_info
+from dataloader.augment import ToUint8Tensor, build_device_transforms
+from dataloader.prefetch import DataPrefetcher, prefetch
+from checkpoint import CheckpointWriter, snapshot, restore, load_checkpoint, to_cpu, unwrap, rng_state, set_rng_state
 from config import *
 from utils import *
 
@@ -29,37 +32,61 @@ from utils import *
 
 torch.backends.cudnn.deterministic = True
 
-def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False, workers=1, distributed=False, rank=0, world_size=1):
+def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False, workers=1, distributed=False, rank=0, world_size=1, batch_aug=False, uint8=False, lazy=False, cache_mb=512):
     """
     Prepare DataLoaders for training, validation, and testing.
     If distributed=True, use DistributedSampler for training and validation sets.
+    If batch_aug=True, the training loader yields raw uint8 batches for BatchAugmentation.
+    If uint8=True, all loaders yield uint8 batches that are normalized once per batch on the device.
+    If lazy=True, images are decoded on access with an LRU cache of cache_mb MiB per loader worker.
     """
     normalize = transforms.Normalize(mean=[0.4802, 0.4481, 0.3975],
                                      std=[0.2302, 0.2265, 0.2262])
     if rank == 0:
         print("Loading training data")
-    train_transform = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.RandomResizedCrop(64),
-            transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            normalize,
-        ])
-
-    test_transform = transforms.Compose([
-            transforms.ToTensor(),
-            normalize
-        ])
+    if batch_aug:
+        train_transform = ToUint8Tensor()
+    elif uint8:
+        train_transform = transforms.Compose([
+                transforms.ToPILImage(),
+                transforms.RandomResizedCrop(64),
+                transforms.RandomHorizontalFlip(),
+                ToUint8Tensor(),
+            ])
+    else:
+        train_transform = transforms.Compose([
+                transforms.ToPILImage(),
+                transforms.RandomResizedCrop(64),
+                transforms.RandomHorizontalFlip(),
+                transforms.ToTensor(),
+                normalize,
+            ])
+
+    if batch_aug or uint8:
+        test_transform = ToUint8Tensor()
+    else:
+        test_transform = transforms.Compose([
+                transforms.ToTensor(),
+                normalize
+            ])
+
+    # Only rank 0 decodes and writes the cache; the other ranks wait here and then
+    # attach to the same memory-mapped files instead of building their own copy.
+    if distributed and rank != 0:
+        dist.barrier()
+    build_cache = rank == 0
 
     # test dataset
-    test_dataset = TinyImageNetDataset(type_='val', raw_data=raw_data, transform=test_transform, force_reload=force_reload)
+    test_dataset = TinyImageNetDataset(type_='val', raw_data=raw_data, transform=test_transform, lazy=lazy, cache_bytes=cache_mb * 2 ** 20, force_reload=force_reload and build_cache)
     if rank == 0:
         print("Validation dataset created, size: ", len(test_dataset))
 
     # full training dataset
-    full_train_dataset = TinyImageNetDataset(type_='train', raw_data=raw_data, transform=train_transform, force_reload=force_reload)
+    full_train_dataset = TinyImageNetDataset(type_='train', raw_data=raw_data, transform=train_transform, lazy=lazy, cache_bytes=cache_mb * 2 ** 20, force_reload=force_reload and build_cache)
     if rank == 0:
         print("Full training dataset created, size: ", len(full_train_dataset))
+    if distributed and rank == 0:
+        dist.barrier()
 
     # split train/val
     full_train_size = len(full_train_dataset)
@@ -78,120 +105,154 @@ def DataLoaderSplit(raw_data, batch_size, val_ratio=0.2, force_reload=False, wor
         val_sampler = None
         test_sampler = None
 
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=(train_sampler is None), pin_memory=True, num_workers=workers, sampler=train_sampler)
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers, sampler=val_sampler)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers, sampler=test_sampler)
+    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=(train_sampler is None), pin_memory=True, num_workers=workers, persistent_workers=lazy and workers > 0, sampler=train_sampler, collate_fn=collate_batch)
+    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers, persistent_workers=lazy and workers > 0, sampler=val_sampler, collate_fn=collate_batch)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, pin_memory=True, num_workers=workers, persistent_workers=lazy and workers > 0, sampler=test_sampler, collate_fn=collate_batch)
 
     if rank == 0:
         print("DataLoaders created.")
 
     return train_loader, val_loader, test_loader
 
-def train(model, iterator, optimizer, criterion, device='cpu', scaler=None, rank=0):
-    epoch_loss = 0
-    epoch_acc = 0
+def train(model, iterator, optimizer, criterion, device='cpu', scaler=None, rank=0, preprocess=None, timer=None, log_every=50, amp_dtype=None, memory_format=None):
+    iterator = prefetch(iterator, device)
+    timer = StepTimer() if timer is None else timer
+    metrics = MetricAccumulator(device)
     model.train()
     if rank == 0:
         pbar = tqdm(enumerate(iterator), total=len(iterator), desc='Training', leave=False)
 
-    for i, (x,label) in enumerate(iterator):
-        x = x.to(device)
-        y = label.to(device)
+    timer.reset()
+    for i, (x, y) in enumerate(iterator):
+        timer.mark('data')
+        timer.add('h2d', iterator.copy_time)
+        if preprocess is not None:
+            x = preprocess(x)
+        if memory_format is not None:
+            x = x.contiguous(memory_format=memory_format)
+        timer.mark('preprocess')
         optimizer.zero_grad()
+        with autocast_context(device, amp_dtype):
+            y_pred, h = model(x)
+            loss = criterion(y_pred, y)
+        metrics.update(loss, y_pred, y)
+        timer.mark('forward')
         if scaler is not None:
-            with autocast('cuda'):
-                y_pred, h = model(x)
-                loss = criterion(y_pred, y)
-                acc = calculate_accuracy(y_pred, y)
-
             scaler.scale(loss).backward()
+            timer.mark('backward')
             scaler.step(optimizer)
             scaler.update()
         else:
-            y_pred, h = model(x)
-            loss = criterion(y_pred, y)
-            acc = calculate_accuracy(y_pred, y)
             loss.backward()
+            timer.mark('backward')
             optimizer.step()
+        timer.mark('optimizer')
 
         # loss.backward()
         # optimizer.step()
         if rank == 0:
-            pbar.set_postfix(loss=loss.item(), acc=acc.item())
+            # local running means of rank 0, read back from the device every log_every steps
+            if (i + 1) % log_every == 0 or i + 1 == len(iterator):
+                _, (epoch_loss, epoch_acc) = metrics.flush()
+                pbar.set_postfix(loss=epoch_loss, acc=epoch_acc)
             pbar.update(1)
-
-        epoch_loss += loss.item()
-        epoch_acc += acc.item()
+        timer.mark('logging')
     
     if rank == 0:
         pbar.close()
 
-    # 在分布式环境下，需要对loss和acc进行reduce求平均
-    avg_loss = torch.tensor(epoch_loss / len(iterator), device=device)
-    avg_acc = torch.tensor(epoch_acc / len(iterator), device=device)
-    dist.all_reduce(avg_loss, op=dist.ReduceOp.SUM)
-    dist.all_reduce(avg_acc, op=dist.ReduceOp.SUM)
-    avg_loss = avg_loss / dist.get_world_size()
-    avg_acc = avg_acc / dist.get_world_size()
-
-    return avg_loss.item(), avg_acc.item()
+    # 在分布式环境下，对loss和正确数、样本数的总和进行reduce，得到按样本加权的均值
+    dist.all_reduce(metrics.sums, op=dist.ReduceOp.SUM)
+    return metrics.mean()
 
-def evaluate(model, iterator, criterion, device='cpu', rank=0):
-    epoch_loss = 0
-    epoch_acc = 0
+def evaluate(model, iterator, criterion, device='cpu', rank=0, preprocess=None, log_every=50, amp_dtype=None, memory_format=None):
+    iterator = prefetch(iterator, device)
+    metrics = MetricAccumulator(device)
     model.eval()
     if rank == 0:
         pbar = tqdm(enumerate(iterator), total=len(iterator), desc='Evaluation', leave=False)
 
     with torch.no_grad():
-        for i, (x, label) in enumerate(iterator):
-            x = x.to(device)
-            y = label.to(device)
+        for i, (x, y) in enumerate(iterator):
+            if preprocess is not None:
+                x = preprocess(x)
+            if memory_format is not None:
+                x = x.contiguous(memory_format=memory_format)
 
-            with autocast('cuda'):
+            with autocast_context(device, amp_dtype):
 
                 y_pred, h = model(x)
                 loss = criterion(y_pred, y)
-                acc = calculate_accuracy(y_pred, y)
+            metrics.update(loss, y_pred, y)
             if rank == 0:
-                pbar.set_postfix(loss=loss.item(), acc=acc.item())
+                if (i + 1) % log_every == 0 or i + 1 == len(iterator):
+                    _, (epoch_loss, epoch_acc) = metrics.flush()
+                    pbar.set_postfix(loss=epoch_loss, acc=epoch_acc)
                 pbar.update(1)
-            epoch_loss += loss.item()
-            epoch_acc += acc.item()
     if rank == 0:
         pbar.close()
 
-    # 分布式求平均
-    avg_loss = torch.tensor(epoch_loss / len(iterator), device=device)
-    avg_acc = torch.tensor(epoch_acc / len(iterator), device=device)
-    dist.all_reduce(avg_loss, op=dist.ReduceOp.SUM)
-    dist.all_reduce(avg_acc, op=dist.ReduceOp.SUM)
-    avg_loss = avg_loss / dist.get_world_size()
-    avg_acc = avg_acc / dist.get_world_size()
+    # 分布式求和后按样本数平均
+    dist.all_reduce(metrics.sums, op=dist.ReduceOp.SUM)
+    return metrics.mean()
 
-    return avg_loss.item(), avg_acc.item()
-
-def train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, half=False,scheduler=None, device='cpu', rank=0):
-    log_history = {'train_loss': [], 'val_loss': [], 'train_acc': [], 'val_acc': [], 'lr': []}
+def train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, half=False,scheduler=None, device='cpu', rank=0, train_preprocess=None, eval_preprocess=None, num_prefetch=2, time_steps=False, log_every=50, checkpoint_dir=None, checkpoint_every=1, resume=False, train_amp_dtype=None, eval_amp_dtype=None, memory_format=None):
+    """
+    With a checkpoint_dir, rank 0 writes the full training state (including the RNG states
+    of every rank) to last.pth every checkpoint_every epochs and to best.pth on every new
+    best validation accuracy, in the background. With resume=True all ranks continue after
+    the epoch stored in last.pth. best_parms has no 'module.' prefix.
+    """
+    log_history = {'train_loss': [], 'val_loss': [], 'train_acc': [], 'val_acc': [], 'lr': [], 'train_data_wait': [], 'val_data_wait': []}
+    timer = StepTimer(enabled=time_steps, device=device)
+    if time_steps:
+        log_history['step_timing'] = []
+    # batches are prepared and copied to the device in the background, see DataPrefetcher
+    train_batches = DataPrefetcher(train_loader, device, num_prefetch=num_prefetch, time_copies=time_steps)
+    val_batches = DataPrefetcher(val_loader, device, num_prefetch=num_prefetch)
     best_acc = 0
-    best_parms = model.state_dict()
+    # a CPU copy, model.state_dict() alone would alias the live weights
+    best_parms = to_cpu(unwrap(model).state_dict())
     scaler = GradScaler('cuda') if half else None
+    start_epoch = 0
+    checkpoints = CheckpointWriter(checkpoint_dir) if checkpoint_dir is not None and rank == 0 else None
+    last_path = os.path.join(checkpoint_dir, "last.pth") if checkpoint_dir is not None else None
+    if resume and last_path is not None and os.path.exists(last_path):
+        state = load_checkpoint(last_path)
+        start_epoch = restore(state, model, optimizer, scheduler, scaler, restore_rng=False)
+        if len(state['rng']) == dist.get_world_size():
+            set_rng_state(state['rng'][rank])
+        elif rank == 0:
+            print(f"Checkpoint was written by {len(state['rng'])} ranks, RNG states are not restored")
+        best_acc = state['best_acc']
+        log_history = state['log_history']
+        if time_steps:
+            # the saving run may have been started without --time-steps; None marks untimed epochs
+            step_timing = log_history.setdefault('step_timing', [])
+            step_timing += [None] * (len(log_history['train_loss']) - len(step_timing))
+        best_path = os.path.join(checkpoint_dir, "best.pth")
+        if os.path.exists(best_path):
+            best_parms = load_checkpoint(best_path)['model']
+        if rank == 0:
+            print(f"Resuming from {last_path} at epoch {start_epoch}")
+    elif resume and rank == 0:
+        print("No checkpoint to resume from, starting from scratch")
     if rank == 0:
-        pbar = tqdm(total=num_epochs)
+        pbar = tqdm(total=num_epochs, initial=start_epoch)
     else:
         pbar = None
 
-    for epoch in range(num_epochs):
+    for epoch in range(start_epoch, num_epochs):
         # 在分布式训练中，每个epoch需要对sampler进行一次set_epoch，以便随机种子同步
         if hasattr(train_loader.sampler, 'set_epoch'):
             train_loader.sampler.set_epoch(epoch)
         if hasattr(val_loader.sampler, 'set_epoch'):
             val_loader.sampler.set_epoch(epoch)
 
-        train_loss, train_acc = train(model, train_loader, optimizer, criterion,scaler=scaler, device=device, rank=rank)
+        train_loss, train_acc = train(model, train_batches, optimizer, criterion,scaler=scaler, device=device, rank=rank, preprocess=train_preprocess, timer=timer, log_every=log_every, amp_dtype=train_amp_dtype, memory_format=memory_format)
         if scheduler is not None:
             scheduler.step()
-        valid_loss, valid_acc = evaluate(model, val_loader, criterion, device, rank)
+        valid_loss, valid_acc = evaluate(model, val_batches, criterion, device, rank, preprocess=eval_preprocess, log_every=log_every, amp_dtype=eval_amp_dtype, memory_format=memory_format)
 
         if rank == 0:
             pbar.set_postfix(train_loss=train_loss, valid_loss=valid_loss, train_acc=train_acc, valid_acc=valid_acc)
@@ -200,14 +261,42 @@ def train_model(model, num_epochs, train_loader, val_loader, optimizer, criterio
             log_history['train_acc'].append(train_acc)
             log_history['val_acc'].append(valid_acc)
             log_history['lr'].append(optimizer.param_groups[0]['lr'])
-
-            if valid_acc > best_acc and epoch > 0.1 * num_epochs:
-                best_acc = valid_acc
-                best_parms = model.state_dict()
+            log_history['train_data_wait'].append(train_batches.wait_time)
+            log_history['val_data_wait'].append(val_batches.wait_time)
+            if time_steps:
+                # step times of rank 0; the ranks run in lockstep through the gradient all-reduce
+                log_history['step_timing'].append(timer.summary())
+            # image cache of the loader workers of rank 0, train and val share it
+            cache_info = dataset_cache_info(train_loader.dataset)
+            if cache_info is not None:
+                log_cache_info(cache_info, epoch)
+                log_history.setdefault('image_cache', []).append(cache_info)
 
             pbar.update(1)
+
+        # valid_acc is all-reduced, so every rank takes the same decisions here
+        is_best = valid_acc > best_acc and epoch > 0.1 * num_epochs
+        if is_best:
+            best_acc = valid_acc
+        is_periodic = (epoch + 1) % checkpoint_every == 0 or epoch + 1 == num_epochs
+        if checkpoint_dir is not None and (is_best or is_periodic):
+            # every rank contributes its RNG state, only rank 0 copies the full state to the host
+            rngs = [None] * dist.get_world_size() if checkpoints is not None else None
+            dist.gather_object(rng_state(), rngs, dst=0)
+        if checkpoints is not None and (is_best or is_periodic):
+            state = snapshot(model, optimizer, scheduler, scaler, epoch=epoch, best_acc=best_acc,
+                             log_history=log_history, rng=rngs)
+            if is_best:
+                best_parms = state['model']
+                checkpoints.save(state, "best")
+            if is_periodic:
+                checkpoints.save(state, "last")
+        elif is_best:
+            best_parms = to_cpu(unwrap(model).state_dict())
     if pbar is not None:
         pbar.close()
+    if checkpoints is not None:
+        checkpoints.close()
     return log_history, best_parms
 
 def get_args_parser():
@@ -249,6 +338,18 @@ def get_args_parser():
     parser.add_argument("--wo-skip", action="store_false", help="without skip connection in the model")
     parser.add_argument("--writer", action="store_true", help="Enable Tensorboard logging")
     parser.add_argument('--half', action='store_true', help='use half precision')
+    parser.add_argument('--precision', default='auto', type=str, choices=['auto', 'fp32', 'bf16', 'fp16'], help='autocast precision (auto: fp16 on CUDA, bf16 on CPU)')
+    parser.add_argument('--batch-aug', action='store_true', help='augment whole uint8 batches on the device instead of per-sample PIL transforms')
+    parser.add_argument('--uint8', action='store_true', help='loaders yield uint8 batches, normalize once per batch on the device')
+    parser.add_argument('--lazy', action='store_true', help='decode images on access instead of preloading the dataset')
+    parser.add_argument('--cache-mb', default=512, type=int, help='LRU cache of decoded images per loader worker in lazy mode (MiB)')
+    parser.add_argument('--prefetch', default=2, type=int, help='number of batches prepared on the device ahead of the training step')
+    parser.add_argument('--time-steps', action='store_true', help='record per-phase step times (synchronizes the device)')
+    parser.add_argument('--log-every', default=50, type=int, help='read metrics back from the device every N steps')
+    parser.add_argument('--checkpoint-every', default=1, type=int, help='save the full training state every N epochs')
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint in the output directory')
+    parser.add_argument('--channels-last', action='store_true', help='keep the model and every batch in channels_last (NHWC) memory format')
+    parser.add_argument('--compile', action='store_true', help='wrap the model with torch.compile')
     parser.add_argument('--val', default=0.2, type=float, help='validation ratio')
     parser.add_argument('--checkpoint', default=None, type=str, help='path to checkpoint')
     parser.add_argument("--dropout", default=0.0, type=float, help="dropout rate (default: 0.0)")
@@ -257,13 +358,27 @@ def get_args_parser():
 
 def main(args):
     # 初始化分布式训练环境
-    dist.init_process_group(backend="nccl")
+    use_cuda = torch.cuda.is_available()
+    dist.init_process_group(backend="nccl" if use_cuda else "gloo")
     local_rank = int(os.environ["LOCAL_RANK"])
     rank = dist.get_rank()
     world_size = dist.get_world_size()
 
-    torch.cuda.set_device(local_rank)
-    device = torch.device("cuda", local_rank)
+    if use_cuda:
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+    else:
+        device = torch.device("cpu")
+
+    # Mixed precision: evaluation autocasts with the chosen dtype; on CUDA training stays in
+    # fp32 under 'auto' unless --half adds fp16 autocast with a GradScaler
+    eval_amp_dtype = autocast_dtype(device, args.precision)
+    if use_cuda and args.precision == 'auto' and not args.half:
+        train_amp_dtype = None
+    else:
+        train_amp_dtype = eval_amp_dtype
+    if args.half and train_amp_dtype != torch.float16:
+        raise ValueError("--half needs fp16 autocast on a GPU")
 
     data_path = args.data_path
     batch_size = args.batch_size
@@ -273,10 +388,11 @@ def main(args):
     force_reload = args.force_reload
 
     if rank == 0:
-        print("Running distributed training on {} GPUs.".format(world_size))
+        print("Running distributed training on {} {}.".format(world_size, "GPUs" if use_cuda else "CPU processes"))
         print("Cuda available device counts = ", torch.cuda.device_count())
         for i in range(torch.cuda.device_count()):
             print(f"GPU {i}: {torch.cuda.get_device_name(i)}")
+        print(f"Autocast dtype: train {train_amp_dtype or 'fp32'}, eval {eval_amp_dtype or 'fp32'}")
 
     # Load raw data
     raw_data = RawData(data_path)
@@ -284,11 +400,16 @@ def main(args):
     if rank == 0:
         print(f"Number of classes: {num_classes}")
     # Create DataLoader objects
-    train_loader, val_loader, test_loader = DataLoaderSplit(raw_data, batch_size, val_ratio=args.val, force_reload=force_reload, workers=workers, distributed=True, rank=rank, world_size=world_size)
+    train_loader, val_loader, test_loader = DataLoaderSplit(raw_data, batch_size, val_ratio=args.val, force_reload=force_reload, workers=workers, distributed=True, rank=rank, world_size=world_size, batch_aug=args.batch_aug, uint8=args.uint8, lazy=args.lazy, cache_mb=args.cache_mb)
     
     # Set up the loss function
     criterion = nn.CrossEntropyLoss(label_smoothing=args.smoothing)
 
+    # Batch transforms applied on the device (uint8 loaders)
+    train_preprocess, eval_preprocess = build_device_transforms(batch_aug=args.batch_aug, uint8=args.uint8)
+    if train_preprocess is not None:
+        train_preprocess, eval_preprocess = train_preprocess.to(device), eval_preprocess.to(device)
+
     # Create the model
     if args.model == "vgg11":
         model = VGG(vgg11_config, num_classes, use_norm=args.wo_norm)
@@ -329,8 +450,18 @@ def main(args):
             print(f"Model loaded from {args.checkpoint}")
     
     model = model.to(device)
+    # convert before DDP, which registers hooks on the parameters and broadcasts them as they are
+    memory_format = torch.channels_last if args.channels_last else None
+    if memory_format is not None:
+        model = model.to(memory_format=memory_format)
     # 使用DDP包装模型
-    model = DDP(model, device_ids=[local_rank], output_device=local_rank, find_unused_parameters=False)
+    if use_cuda:
+        model = DDP(model, device_ids=[local_rank], output_device=local_rank, find_unused_parameters=False)
+    else:
+        model = DDP(model, find_unused_parameters=False)
+    if args.compile:
+        # compiling the DDP wrapper lets dynamo split graphs at the gradient buckets
+        model = torch.compile(model)
     # Load checkpoint
 
     if rank == 0:
@@ -383,18 +514,18 @@ def main(args):
         print(f"Learning rate scheduler: {args.lr_scheduler}")
 
     if args.checkpoint is not None:
-        test_loss, test_acc = evaluate(model, test_loader, criterion, device, rank=rank)
+        test_loss, test_acc = evaluate(model, test_loader, criterion, device, rank=rank, preprocess=eval_preprocess, amp_dtype=eval_amp_dtype, memory_format=memory_format)
         if rank == 0:
             print(f"At checkpoint, test Loss: {test_loss:.4f}, test Acc: {test_acc:.4f}")
 
     # Train the model
-    log_history,best_parms = train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, half=args.half, scheduler=lr_scheduler, device=device, rank=rank)
+    log_history,best_parms = train_model(model, num_epochs, train_loader, val_loader, optimizer, criterion, half=args.half, scheduler=lr_scheduler, device=device, rank=rank, train_preprocess=train_preprocess, eval_preprocess=eval_preprocess, num_prefetch=args.prefetch, time_steps=args.time_steps, log_every=args.log_every, checkpoint_dir=os.path.join(save_dir, args.model, "checkpoints"), checkpoint_every=args.checkpoint_every, resume=args.resume, train_amp_dtype=train_amp_dtype, eval_amp_dtype=eval_amp_dtype, memory_format=memory_format)
     if rank == 0:
         print("Training complete.")
 
     dist.barrier()
-    model.load_state_dict(best_parms)
-    test_loss, test_acc = evaluate(model, test_loader, criterion, device, rank=rank)
+    unwrap(model).load_state_dict(best_parms)
+    test_loss, test_acc = evaluate(model, test_loader, criterion, device, rank=rank, preprocess=eval_preprocess, amp_dtype=eval_amp_dtype, memory_format=memory_format)
 
     if rank == 0:
         print(f"Test Loss: {test_loss:.4f}, Test Acc: {test_acc:.4f}")
@@ -426,6 +557,10 @@ def main(args):
                 writer.add_scalar('Accuracy/train', t_acc, epoch)
                 writer.add_scalar('Accuracy/val', v_acc, epoch)
                 writer.add_scalar('LearningRate', lr_, epoch)
+                writer.add_scalar('DataWait/train', log_history['train_data_wait'][epoch], epoch)
+                writer.add_scalar('DataWait/val', log_history['val_data_wait'][epoch], epoch)
+                if args.time_steps and log_history['step_timing'][epoch] is not None:
+                    StepTimer.write_summary(writer, log_history['step_timing'][epoch], epoch)
 
             # Record test loss and accuracy
             writer.add_scalar('Test/Loss', log_history['test_loss'], args.num_epochs)
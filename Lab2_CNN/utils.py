@@ -1,5 +1,7 @@
 
 import os
+import time
+from contextlib import nullcontext
 import numpy as np
 import cv2
 import torch
@@ -7,6 +9,7 @@ from torch.utils.data import Dataset, DataLoader, random_split
 import torchvision.transforms as transforms
 from multiprocessing import Pool, cpu_count
 from PIL import Image
+from tqdm import tqdm
 import matplotlib.pyplot as plt
 
 def calculate_accuracy(y_pred: torch.Tensor, y: torch.Tensor):
@@ -15,6 +18,138 @@ def calculate_accuracy(y_pred: torch.Tensor, y: torch.Tensor):
     acc = correct.float() / y.shape[0]
     return acc
 
+def autocast_dtype(device, precision='auto'):
+    """
+    Autocast dtype for a precision setting on device, None for plain fp32.
+    'auto' is fp16 on CUDA (with GradScaler if requested) and bfloat16 on CPU.
+    """
+    device = torch.device(device)
+    if precision == 'fp32':
+        return None
+    if precision == 'auto':
+        precision = 'fp16' if device.type == 'cuda' else 'bf16'
+    if precision == 'fp16' and device.type == 'cpu':
+        raise ValueError("fp16 autocast is not supported on CPU, use bf16 or fp32")
+    return {'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+
+def autocast_context(device, dtype):
+    """torch.autocast for the device type, or a no-op when dtype is None."""
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=dtype)
+
+
+class MetricAccumulator:
+    """
+    Running sums of loss * batch size, correct predictions and samples, kept on the device.
+
+    update() only launches device ops; the sums are copied to the host in one transfer
+    when read, so the step loop does not wait on the device every step. Means are
+    sample-weighted over everything seen, not means of batch means.
+    """
+    def __init__(self, device='cpu'):
+        self.sums = torch.zeros(3, dtype=torch.float64, device=device)
+        self.flushed = [0.0, 0.0, 0.0]
+
+    @torch.no_grad()
+    def update(self, loss, y_pred, y):
+        n = y.shape[0]
+        self.sums[0] += loss.detach().double() * n
+        self.sums[1] += y_pred.argmax(1).eq(y).sum()
+        self.sums[2] += n
+
+    @staticmethod
+    def _means(sums):
+        loss_sum, correct, count = sums
+        return (loss_sum / count, correct / count) if count > 0 else (0.0, 0.0)
+
+    def mean(self):
+        """(loss, accuracy) over all updates."""
+        return self._means(self.sums.tolist())
+
+    def flush(self):
+        """(loss, accuracy) over the updates since the previous flush, and over all updates."""
+        sums = self.sums.tolist()
+        window = [total - previous for total, previous in zip(sums, self.flushed)]
+        self.flushed = sums
+        return self._means(window), self._means(sums)
+
+
+class StepTimer:
+    """
+    Wall time of the phases of a training step.
+
+    Call mark(phase) at the end of every phase; the time since the previous mark is
+    attributed to it. When enabled, the current stream is synchronized before each timestamp
+    so asynchronous kernels are charged to the phase that launched them. When disabled,
+    mark() returns right away and the step loop runs without any synchronization.
+
+    h2d is not a step phase: it is the background copy of the batch measured by the
+    DataPrefetcher and recorded with add(); the step loop only waits for it in `data`.
+    """
+    PHASES = ("data", "h2d", "preprocess", "forward", "backward", "optimizer", "logging")
+
+    def __init__(self, enabled=False, device='cpu'):
+        self.enabled = enabled
+        self.device = torch.device(device)
+        self.times = {phase: [] for phase in self.PHASES}
+        self.last = None
+
+    def _now(self):
+        if self.device.type == "cuda":
+            # not torch.cuda.synchronize(): that would also wait for the prefetch copies of later batches
+            torch.cuda.current_stream(self.device).synchronize()
+        return time.perf_counter()
+
+    def reset(self):
+        """Start a new epoch: drop the recorded times and take the reference timestamp."""
+        if not self.enabled:
+            return
+        self.times = {phase: [] for phase in self.PHASES}
+        self.last = self._now()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = self._now()
+        self.times[phase].append(now - self.last)
+        self.last = now
+
+    def add(self, phase, seconds):
+        """Record a duration measured elsewhere, without moving the reference timestamp."""
+        if self.enabled and seconds is not None:
+            self.times[phase].append(seconds)
+
+    def summary(self):
+        """Per phase mean / p50 / p90 / p99 / total in milliseconds, phases without samples are left out."""
+        if not self.enabled:
+            return {}
+        summary = {}
+        for phase, times in self.times.items():
+            if not times:
+                continue
+            ms = np.array(times) * 1000
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            summary[phase] = {'mean': float(ms.mean()), 'p50': float(p50), 'p90': float(p90),
+                              'p99': float(p99), 'total': float(ms.sum())}
+        return summary
+
+    @staticmethod
+    def write_summary(writer, summary, step):
+        for phase, stats in summary.items():
+            for name in ('p50', 'p90', 'p99'):
+                writer.add_scalar(f'StepTime/{phase}_{name}', stats[name], step)
+
+
+def log_cache_info(info, epoch, writer=None):
+    """Print the image cache counters of dataset_cache_info() and write them to TensorBoard."""
+    tqdm.write(f"Image cache: {info['hit_rate']:.1%} hit rate, {info['hits']} hits, {info['misses']} misses, "
+               f"{info['evictions']} evictions, {info['items']} images in {info['bytes'] / 2 ** 20:.0f} MiB")
+    if writer is not None:
+        for key in ("hit_rate", "hits", "misses", "evictions", "bytes"):
+            writer.add_scalar(f'ImageCache/{key}', info[key], epoch)
+
+
 def print_gpu_memory():
     if not torch.cuda.is_available():
         print("CUDA is not available.")